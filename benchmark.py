@@ -0,0 +1,232 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+import converttojson as conv
+
+# kinds of synthetic maps in the corpus.
+#   dense: every tile layer filled, like a finished area.
+#   sparse: mostly empty tile layers with a scattering of events and items.
+#   bunmania: a dense map with bunmania metadata encoded in the first event rows.
+MAP_KINDS = ('dense', 'sparse', 'bunmania')
+
+def random_tile(r):
+    # a game tile id the json side can represent: the last 2 of every 32 ids are unused.
+    i = r.randrange(0, 80)*32 + r.randrange(0, 30)
+    if i == 0: i = 1
+    if r.random() < 0.05: i += 5000
+    if r.random() < 0.05: i = -i
+    return i
+
+def generate_map(kind, seed):
+    r = random.Random(seed)
+    buf = bytearray(conv.MAP_FILE_SIZE)
+    dense = kind != 'sparse'
+
+    def put(name, values):
+        offset = dict((n, o) for n, o, size in conv.MAP_SECTIONS)[name]
+        struct.pack_into('%dh' % len(values), buf, offset, *values)
+
+    fill = 0.7 if dense else 0.05
+    put('collision', [r.randrange(1, 40) if r.random() < fill else 0 for _ in range(conv.MAP_SIZE)])
+    for k in range(7):
+        layer_fill = fill if k < 4 else fill/4
+        put('tiles%d' % k, [random_tile(r) if r.random() < layer_fill else 0 for _ in range(conv.MAP_SIZE)])
+
+    for name, count, limit in (('event', 400 if dense else 150, 800), ('items', 80 if dense else 30, 300)):
+        values = [0]*conv.MAP_SIZE
+        for _ in range(count): values[r.randrange(200*20, conv.MAP_SIZE)] = r.randrange(1, limit)
+        if name == 'event' and kind == 'bunmania':
+            rows = [
+                [5000+ord(c) for c in 'Benchmark Map %d' % seed],
+                [5000+ord(c) for c in 'bench'],
+            ] + [[5000+r.randrange(0, 3), 5000+r.randrange(0, 60), 5000+r.randrange(0, 60)] for _ in range(5)] \
+              + [[5001], [5000+r.randrange(0, 4)], [5000+r.randrange(0, 30)]]
+            for row, data in enumerate(rows):
+                for x, v in enumerate(data): values[row+200*x] = v
+        put(name, values)
+
+    for name in ('roomtype', 'roomcolor', 'roombg'):
+        put(name, [r.randrange(0, 20) for _ in range(conv.MINIMAP_SIZE)])
+    struct.pack_into('i', buf, conv.INT_AREA, seed % 10)
+    struct.pack_into('i', buf, conv.INT_VERSION, 1)
+    return bytes(buf)
+
+def generate_corpus(directory, maps_per_kind):
+    filenames = []
+    for kind in MAP_KINDS:
+        for i in range(maps_per_kind):
+            filename = '%s%d' % (kind, i)
+            f = open('%s/%s.map' % (directory, filename), 'wb')
+            f.write(generate_map(kind, len(filenames)))
+            f.close()
+            filenames.append(filename)
+    return filenames
+
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def benchmark_stages(mapfile, repeat):
+    # times each stage of a conversion on its own, on one map.
+    tile_names = ['tiles%d' % k for k in range(7)]
+    def read():
+        f = open(mapfile, 'rb')
+        raw = f.read()
+        f.close()
+        return conv.RabiRibiMap.from_bytes(raw)
+    f = open(mapfile, 'rb')
+    raw = f.read()
+    f.close()
+    rbmap = conv.RabiRibiMap.from_bytes(raw)
+    sections = rbmap.sections()
+    transposed = [conv.transpose_d2l(sections[name]) for name in tile_names]
+
+    def serialize():
+        out = io.StringIO()
+        data, layers = conv.map_sections_to_tiled(sections)
+        conv.write_json_stream(out, data, 'layers', layers)
+        return out.getvalue()
+    text = serialize()
+    jsondata = conv.parse_tiled_json(text)
+    # decoded once here, so the pack stage only times packing.
+    with contextlib.redirect_stdout(io.StringIO()):
+        map_arrays = conv.tiled_to_map_arrays(jsondata)
+    target = tempfile.NamedTemporaryFile(delete=False)
+    target.close()
+
+    def write():
+        f = open(target.name, 'wb')
+        f.write(raw)
+        f.close()
+
+    stages = [
+        ('read', read),
+        ('metadata', lambda: conv.extract_encoded_metadata(conv.nonzero_cells(sections['event']))),
+        ('transpose', lambda: [conv.transpose_l2d(conv.transpose_d2l(sections[name])) for name in tile_names]),
+        ('gid-encode', lambda: [list(map(conv.tile_gid_table().__getitem__, data)) for data in transposed]),
+        ('serialize', serialize),
+        ('parse', lambda: conv.parse_tiled_json(text)),
+        ('gid-decode', lambda: conv.tiled_to_map_arrays(jsondata)),
+        ('pack', lambda: conv.pack_map_arrays(bytearray(raw), raw, map_arrays)),
+        ('write', write),
+    ]
+    results = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, function in stages:
+            results[name] = best_time(function, repeat)
+    os.remove(target.name)
+    return results
+
+def benchmark_batch(directory, filenames, jobs, repeat):
+    # times full map_to_json and json_to_map runs over the corpus.
+    settings = argparse.Namespace(
+        original_maps_dir=directory,
+        editable_maps_dir=os.path.join(directory, 'editable'),
+        final_maps_dir=os.path.join(directory, 'final'),
+        layer_encoding='array',
+        chunked=False,
+        tilesets=None,
+        layers=None,
+        from_pack=False,
+        profile=None,
+        jobs=jobs,
+    )
+
+    def map_to_json():
+        shutil.rmtree(settings.editable_maps_dir, ignore_errors=True)
+        os.makedirs(settings.editable_maps_dir)
+        conv.convert_all(conv.map_to_json, filenames, settings)
+
+    def json_to_map():
+        shutil.rmtree(settings.final_maps_dir, ignore_errors=True)
+        os.makedirs(settings.final_maps_dir)
+        conv.convert_all(conv.json_to_map, filenames, settings)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return {
+            'batch map_to_json (jobs=%d)' % jobs: best_time(map_to_json, repeat),
+            'batch json_to_map (jobs=%d)' % jobs: best_time(json_to_map, repeat),
+        }
+
+def compare_to_baseline(results, baseline, threshold):
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline: continue
+        ratio = seconds / baseline[name] if baseline[name] > 0 else 1
+        if ratio > 1 + threshold:
+            regressions.append((name, baseline[name], seconds, ratio))
+    return regressions
+
+def parse_args():
+    args = argparse.ArgumentParser(description='Rabi-Ribi Map Converter benchmarks')
+    args.add_argument('--maps-per-kind', type=int, default=2, help='Number of synthetic maps of each kind (%s) in the corpus. Defaults to 2.' % ', '.join(MAP_KINDS))
+    args.add_argument('--repeat', type=int, default=3, help='Runs of each benchmark. The best time is kept. Defaults to 3.')
+    args.add_argument('--jobs', type=int, default=0, help='Jobs for the parallel batch benchmark. Use 0 for one job per CPU core. Defaults to 0.')
+    args.add_argument('--corpus-dir', default=None, help='Directory to generate the corpus in. Defaults to a temporary directory that is deleted afterwards.')
+    args.add_argument('--save-baseline', default=None, help='Write the results to this json file, to compare later runs against.')
+    args.add_argument('--baseline', default=None, help='Compare the results against this baseline json file.')
+    args.add_argument('--threshold', type=float, default=0.25, help='Fraction a benchmark may be slower than its baseline before it counts as a regression. Defaults to 0.25.')
+    return args.parse_args(sys.argv[1:])
+
+def main():
+    settings = parse_args()
+    directory = settings.corpus_dir or tempfile.mkdtemp(prefix='rbrb_bench_')
+    if not os.path.isdir(directory): os.makedirs(directory)
+
+    try:
+        print('Generating %d synthetic maps in %s' % (settings.maps_per_kind * len(MAP_KINDS), directory))
+        filenames = generate_corpus(directory, settings.maps_per_kind)
+
+        results = {}
+        for kind in MAP_KINDS:
+            for stage, seconds in benchmark_stages('%s/%s0.map' % (directory, kind), settings.repeat).items():
+                results['%s %s' % (kind, stage)] = seconds
+        jobs = settings.jobs if settings.jobs > 0 else os.cpu_count()
+        results.update(benchmark_batch(directory, filenames, 1, settings.repeat))
+        if jobs > 1:
+            results.update(benchmark_batch(directory, filenames, jobs, settings.repeat))
+    finally:
+        if settings.corpus_dir == None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    width = max(len(name) for name in results)
+    for name, seconds in results.items():
+        print('%s  %9.2f ms' % (name.ljust(width), seconds * 1000))
+
+    # batch times depend on the corpus size, so baselines remember it.
+    corpus = {'maps_per_kind': settings.maps_per_kind, 'jobs': jobs}
+    if settings.save_baseline:
+        f = open(settings.save_baseline, 'w')
+        f.write(json.dumps({'corpus': corpus, 'results': results}, indent=1))
+        f.close()
+        print('Saved baseline to %s' % settings.save_baseline)
+
+    if settings.baseline:
+        f = open(settings.baseline)
+        baseline = json.loads(f.read())
+        f.close()
+        if baseline['corpus'] != corpus:
+            print('The baseline was made with a different corpus (%s). Only per-stage times are compared.' % baseline['corpus'])
+            baseline['results'] = dict((k, v) for k, v in baseline['results'].items() if not k.startswith('batch '))
+        regressions = compare_to_baseline(results, baseline['results'], settings.threshold)
+        for name, before, after, ratio in regressions:
+            print('REGRESSION: %s %.2f ms -> %.2f ms (%.0f%% slower)' % (name, before * 1000, after * 1000, (ratio - 1) * 100))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against %s' % settings.baseline)
+
+if __name__ == '__main__':
+    main()
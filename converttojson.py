@@ -1,9 +1,27 @@
-import shutil
 import struct
 import json
 import os
 import sys
 import argparse
+import mmap
+import time
+import hashlib
+import base64
+import zlib
+import gzip
+import re
+from array import array
+import io
+import traceback
+import tracemalloc
+import multiprocessing
+import socketserver
+import threading
+import contextlib
+import functools
+from itertools import chain, compress, accumulate
+from xml.etree import ElementTree
+from bisect import bisect_left, bisect_right
 INF = float('inf')
 
 #settings.original_maps_dir = './s1_original_maps'
@@ -19,6 +37,22 @@ final-maps-dir: s3_final_maps
 
 HAS_WARNINGS = False
 
+# only the first DIAGNOSTIC_SAMPLES warnings of each code are printed and kept. the rest are counted.
+DIAGNOSTIC_SAMPLES = 10
+# {code: {severity, count, layers, samples}} for the map being converted. None prints every warning.
+DIAGNOSTICS = None
+# diagnostics of every converted map, by filename, for --diagnostics.
+DIAGNOSTIC_REPORTS = {}
+
+# list of profile events while --profile is on, None otherwise.
+PROFILE_EVENTS = None
+PROFILE_FILE = None
+PROFILE_PEAKS = []
+
+# bump this whenever json_to_map produces different output for the same inputs.
+# final maps built by another converter version are rebuilt.
+CONVERTER_VERSION = '1'
+
 def read_config():
     CONFIG_FILE_NAME = './settings.txt'
 
@@ -48,6 +82,11 @@ def parse_args():
     check_for_key('original-maps-dir')
     check_for_key('editable-maps-dir')
     check_for_key('final-maps-dir')
+    config.setdefault('patch-dir', 's4_map_patches')
+    config.setdefault('pack-prefix', 'map_pack')
+    config.setdefault('index-dir', 'map_index')
+    config.setdefault('render-dir', 'map_renders')
+    config.setdefault('rebased-maps-dir', 's2_rebased_maps')
 
     args = argparse.ArgumentParser(description='Rabi-Ribi Map Converter')
     args.add_argument('-original-maps-dir', default=config['original-maps-dir'], help='Source directory for original maps. Defaults to s1_original_maps/. Do not make the original maps dir the final maps dir.')
@@ -55,18 +94,195 @@ def parse_args():
     args.add_argument('-final-maps-dir', default=config['final-maps-dir'], help='Output directory for final map files. Defaults to s3_final_maps/. Do not make the original maps dir the final maps dir.')
     args.add_argument('--map-to-json', action='store_true', help='Use to convert original map files to editable json files.')
     args.add_argument('--json-to-map', action='store_true', help='Use to convert editable json files to final map files.')
+    args.add_argument('-patch-dir', default=config['patch-dir'], help='Directory for map patch files. Defaults to s4_map_patches/.')
+    args.add_argument('--json-to-patch', action='store_true', help='Use to convert editable json files to small patch files against the original maps, instead of full final map files.')
+    args.add_argument('--apply-patches', action='store_true', help='Use to rebuild final map files from the original maps and the patch files in the patch dir.')
+    args.add_argument('--verify', action='store_true', help='Use to check that every original map converts to json and back to the same map, without writing any files. Lists the section and cell of every value that changes.')
+    args.add_argument('--rebase', default=None, metavar='DIR', help='Use when the game updates the original maps, with DIR holding the updated maps. The edits in each editable json file are merged onto its updated map, and the result is written to the rebased maps dir. Values both the edit and the update changed are conflicts. They keep the edited value, and are listed in NAME.conflicts.json next to the rebased json file.')
+    args.add_argument('-rebased-maps-dir', default=config['rebased-maps-dir'], help='Output directory for rebased json files. Defaults to s2_rebased_maps/.')
+    args.add_argument('--check', action='store_true', help='Use to check that every editable json file would convert with --json-to-map, without writing anything. Every error in every file is reported, not only the first. Files are checked in parallel.')
+    args.add_argument('--serve', action='store_true', help='Use to keep the converter running as a local server, answering batched conversion requests on --port. Each request is a line of json, {"id": ..., "direction": ..., "maps": [...], "options": {...}}, answered with a line of json holding the warnings and errors of each map. Directions are map-to-json, json-to-map, json-to-patch, apply-patches, verify and validate.')
+    args.add_argument('--port', type=int, default=SERVE_PORT, help='Use with --serve to choose the localhost port to listen on. Defaults to %d.' % SERVE_PORT)
+    args.add_argument('-pack-prefix', default=config['pack-prefix'], help='Path and name of the map pack archive, without extension. The pack is stored in PREFIX.rbpack and PREFIX.index.json. Defaults to map_pack.')
+    args.add_argument('--pack', action='store_true', help='Use to add the original maps to the map pack. Sections that are the same in several maps are only stored once, compressed. Maps already in the pack with the same name are replaced.')
+    args.add_argument('--unpack', action='store_true', help='Use to extract the maps in the map pack into the original maps dir.')
+    args.add_argument('--from-pack', action='store_true', help='Use with --map-to-json to read the original maps from the map pack instead of the original maps dir.')
+    args.add_argument('--maps', type=lambda names: names.split(','), default=None, metavar='MAP,...', help='Use with --map-to-json, --pack, --unpack, --query, --render or --rebase to only handle the named maps, like --maps area0,area1.')
+    args.add_argument('-index-dir', default=config['index-dir'], help='Directory for the query index. Defaults to map_index/.')
+    args.add_argument('--query', default=None, metavar='SECTION[=VALUE]', help='Use to find where values are used in the original maps, like --query event=500..599, --query items=12 or --query tiles=1234. SECTION is event, items, tiles0-tiles6, tiles (all tile layers), roomtype, roomcolor or roombg. Tile queries match flipped tiles too. The maps are indexed into the index dir, and only reindexed when they change.')
+    args.add_argument('--region', default=None, metavar='X0,Y0,X1,Y1', help='Use with --query to only find cells in this rectangle, inclusive. Rooms are counted in room coordinates.')
+    args.add_argument('--histogram', action='store_true', help='Use with --query to count how many cells use each value instead of listing them. Tiles are counted by tile id, flipped or not.')
+    args.add_argument('-render-dir', default=config['render-dir'], help='Output directory for rendered map images. Defaults to map_renders/.')
+    args.add_argument('--render', action='store_true', help='Use to render the original maps to png images in the render dir, using the tilesets in the editable maps dir. Tile layers are drawn in the same order as in the game.')
+    args.add_argument('--tile-size', type=int, default=8, help='Use with --render to choose the size of a tile in pixels, from 1 to 32. Use 32 for full-size images. Defaults to 8.')
+    args.add_argument('--overlays', type=lambda names: names.split(','), default=[], metavar='OVERLAY,...', help='Use with --render to draw overlays on top of the tiles, like --overlays collision,event,items. Collision is blended at half opacity, events and items are drawn as squares in the colors tiled uses.')
+    args.add_argument('--layer-encoding', default='array', choices=sorted(LAYER_ENCODINGS), help='Use with --map-to-json, --verify or --rebase to choose how tile layers are stored in the json files. Compressed base64 layers are much smaller and faster to load. Defaults to array.')
+    args.add_argument('--chunked', action='store_true', help='Use with --map-to-json, --verify or --rebase to save tile layers as an infinite tiled map, in one chunk per room. Empty rooms are left out, so mostly empty maps are much smaller and open faster.')
+    args.add_argument('--tilesets', type=lambda names: names.split(','), default=None, metavar='TSX,...', help='Use with --map-to-json, --verify or --rebase to split the tiles across several tilesets in the editable maps dir, like --tilesets TILE_A.tsx,TILE_A_2.tsx. Each tileset needs a tile_offset property holding the index of its first tile in the whole tile sheet, unless it starts at tile 0. --json-to-map reads any number of tilesets, telling them apart by name: collision tilesets have collision in their name, and the others TILE_A.')
+    args.add_argument('--layers', type=lambda names: names.split(','), default=None, metavar='LAYER,...', help='Use with --json-to-map to only convert the named layers, like --layers items,event. The other layers of the final maps are kept as they are. Bunmania metadata belongs to the event layer. The final maps must have been built from the current original maps before.')
+    args.add_argument('--watch', action='store_true', help='Use with --json-to-map to keep running after the build, and reconvert each editable json file as soon as it is saved.')
+    args.add_argument('--force', action='store_true', help='Use with --json-to-map to rebuild every final map, even those whose inputs are unchanged since the last build.')
+    args.add_argument('--profile', nargs='?', const='converttojson_profile', default=None, metavar='PREFIX', help='Record the wall time, CPU time and peak memory of every conversion stage. Writes a report to PREFIX.json and a Chrome/Perfetto trace to PREFIX.trace.json. PREFIX defaults to converttojson_profile. Memory tracking makes conversions several times slower, so compare stage times with each other rather than with unprofiled runs.')
+    args.add_argument('--diagnostics', default=None, metavar='PATH', help='Write every warning and error to PATH as json, grouped by map and by kind, with the layer and cell of each. Only the first %d warnings of each kind are printed.' % DIAGNOSTIC_SAMPLES)
+    args.add_argument('--jobs', type=int, default=None, help='Number of maps to convert in parallel. Use 0 for one job per CPU core. Defaults to 1, or to one job per CPU core with --check.')
 
     return args.parse_args(sys.argv[1:])
 
+class ConversionError(Exception):
+    # messages holds each error separately, when several were found at once.
+    def __init__(self, message, messages=None):
+        Exception.__init__(self, message)
+        self.messages = messages or [message]
+
 def fail(message):
-    print('ERROR! %s' % message)
+    raise ConversionError(message)
+
+def fail_all(messages):
+    # fails with every message in messages, if there are any.
+    if len(messages) == 1:
+        fail(messages[0])
+    if messages:
+        raise ConversionError('%d errors found:\n  %s' % (len(messages), '\n  '.join(messages)), messages)
+
+def report_failure(error):
+    print('ERROR! %s' % error)
     print('\nFAILED TO CONVERT')
-    sys.exit(1)
 
-def warn(message):
+def warn(message, code='warning', layer=None, x=None, y=None):
     global HAS_WARNINGS
     HAS_WARNINGS = True
-    print('WARNING: %s' % message)
+    if record_diagnostic('warning', code, layer, sample={'message': message, 'layer': layer, 'x': x, 'y': y}):
+        print('WARNING: %s' % message)
+
+def record_diagnostic(severity, code, layer=None, count=1, sample=None):
+    # counts count diagnostics of the given code. returns whether sample was kept, and so should be shown.
+    if DIAGNOSTICS == None: return True
+    entry = DIAGNOSTICS.setdefault(code, {'severity': severity, 'count': 0, 'layers': {}, 'samples': []})
+    entry['count'] += count
+    if layer != None: entry['layers'][layer] = entry['layers'].get(layer, 0) + count
+    if sample == None or len(entry['samples']) >= DIAGNOSTIC_SAMPLES: return False
+    entry['samples'].append(sample)
+    return True
+
+def start_diagnostics():
+    global DIAGNOSTICS
+    DIAGNOSTICS = {}
+
+def finish_diagnostics(error=None):
+    # prints how many warnings were not shown, and returns the diagnostics report of the map.
+    # error is what stopped the conversion. unless its errors were recorded as they were found,
+    # they are recorded here, so that they are counted too.
+    global DIAGNOSTICS
+    if isinstance(error, Exception) and not any(entry['severity'] == 'error' for entry in DIAGNOSTICS.values()):
+        for message in (error.messages if isinstance(error, ConversionError) else [str(error)]):
+            record_diagnostic('error', 'conversion-failed', sample={'message': message, 'layer': None, 'x': None, 'y': None})
+    codes, DIAGNOSTICS = DIAGNOSTICS, None
+    for code, entry in codes.items():
+        hidden = entry['count'] - len(entry['samples'])
+        if entry['severity'] == 'warning' and hidden > 0:
+            by_layer = ', '.join('%d in %s' % (count, layer) for layer, count in entry['layers'].items())
+            print('WARNING: ... and %d more %s warnings. %d in total%s.' % (hidden, code, entry['count'], by_layer and ': ' + by_layer))
+    return {
+        'warnings': sum(entry['count'] for entry in codes.values() if entry['severity'] == 'warning'),
+        'errors': sum(entry['count'] for entry in codes.values() if entry['severity'] == 'error'),
+        'error': None if error == None else str(error),
+        'codes': codes,
+    }
+
+def diagnosed_conversion(convert, filename, settings):
+    # converts one map, keeping its diagnostics report in DIAGNOSTIC_REPORTS.
+    start_diagnostics()
+    try:
+        profiled_conversion(convert, filename, settings)
+    except BaseException as e:
+        DIAGNOSTIC_REPORTS[filename] = finish_diagnostics(e)
+        raise
+    DIAGNOSTIC_REPORTS[filename] = finish_diagnostics()
+
+def write_diagnostics(path, reports):
+    f = open(path, 'w')
+    f.write(json.dumps({'maps': reports}, indent=1, sort_keys=True))
+    f.close()
+    print('Wrote diagnostics to %s' % path)
+
+def start_profiling():
+    global PROFILE_EVENTS
+    PROFILE_EVENTS = []
+    if not tracemalloc.is_tracing(): tracemalloc.start()
+
+@contextlib.contextmanager
+def profile_stage(name):
+    # records the wall time, cpu time and peak traced memory of the enclosed code.
+    if PROFILE_EVENTS == None:
+        yield
+        return
+    # tracemalloc has a single peak, so nested stages hand theirs up to the enclosing one.
+    if PROFILE_PEAKS:
+        PROFILE_PEAKS[-1] = max(PROFILE_PEAKS[-1], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    PROFILE_PEAKS.append(0)
+    start_time = time.time()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        peak = max(PROFILE_PEAKS.pop(), tracemalloc.get_traced_memory()[1])
+        if PROFILE_PEAKS:
+            PROFILE_PEAKS[-1] = max(PROFILE_PEAKS[-1], peak)
+        PROFILE_EVENTS.append({
+            'name': name,
+            'file': PROFILE_FILE,
+            'pid': os.getpid(),
+            'start': start_time,
+            'wall': wall,
+            'cpu': cpu,
+            'peak_memory': peak,
+        })
+
+def profiled(name, function, *args):
+    with profile_stage(name):
+        return function(*args)
+
+def profiled_conversion(convert, filename, settings):
+    global PROFILE_FILE
+    PROFILE_FILE = filename
+    try:
+        with profile_stage(convert.__name__):
+            convert(filename, settings)
+    finally:
+        PROFILE_FILE = None
+
+def write_profile(prefix, events):
+    # per-stage totals, and a timeline in the chrome trace event format (chrome://tracing, ui.perfetto.dev).
+    stages = {}
+    for event in events:
+        stage = stages.setdefault(event['name'], {'count': 0, 'wall': 0, 'cpu': 0, 'peak_memory': 0})
+        stage['count'] += 1
+        stage['wall'] += event['wall']
+        stage['cpu'] += event['cpu']
+        stage['peak_memory'] = max(stage['peak_memory'], event['peak_memory'])
+    f = open('%s.json' % prefix, 'w')
+    f.write(json.dumps({'stages': stages, 'events': events}, indent=1))
+    f.close()
+
+    first_start = min([event['start'] for event in events] or [0])
+    trace_events = [{
+        'name': event['name'],
+        'cat': 'conversion',
+        'ph': 'X',
+        'ts': (event['start'] - first_start) * 1e6,
+        'dur': event['wall'] * 1e6,
+        'pid': event['pid'],
+        'tid': event['pid'],
+        'args': {'file': event['file'], 'cpu_ms': event['cpu'] * 1000, 'peak_memory': event['peak_memory']},
+    } for event in events]
+    f = open('%s.trace.json' % prefix, 'w')
+    f.write(json.dumps({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}))
+    f.close()
+    print('Wrote profile to %s.json and %s.trace.json' % (prefix, prefix))
 
 MAP_SIZE = 100000
 MINIMAP_SIZE = 450
@@ -86,23 +302,229 @@ ARRAY_TILES_4 = 1402704
 ARRAY_TILES_5 = 1602704
 ARRAY_TILES_6 = 1802704
 INT_VERSION = 2602704
+MAP_FILE_SIZE = INT_VERSION + 4
+
+# (name, offset, number of shorts) of every array section in a .map file
+MAP_SECTIONS = (
+    ('collision', ARRAY_MAP, MAP_SIZE),
+    ('event', ARRAY_EVENT, MAP_SIZE),
+    ('roomtype', ARRAY_ROOMTYPE, MINIMAP_SIZE),
+    ('roomcolor', ARRAY_ROOMCOLOR, MINIMAP_SIZE),
+    ('roombg', ARRAY_ROOMBG, MINIMAP_SIZE),
+    ('items', ARRAY_ITEMS, MAP_SIZE),
+    ('tiles0', ARRAY_TILES_0, MAP_SIZE),
+    ('tiles1', ARRAY_TILES_1, MAP_SIZE),
+    ('tiles2', ARRAY_TILES_2, MAP_SIZE),
+    ('tiles3', ARRAY_TILES_3, MAP_SIZE),
+    ('tiles4', ARRAY_TILES_4, MAP_SIZE),
+    ('tiles5', ARRAY_TILES_5, MAP_SIZE),
+    ('tiles6', ARRAY_TILES_6, MAP_SIZE),
+)
+# (name, offset) of every int field in a .map file
+MAP_INTS = (
+    ('area', INT_AREA),
+    ('version', INT_VERSION),
+)
 
 COLLISION_TILESET_OFFSET = 5000
+# (firstgid, source, kind, tile offset, tile count) of the tilesets in the maps map_to_json writes.
+# the tile offset is the index, among all tiles of its kind, of the first tile of the tileset, so
+# a tileset can be split into several. a tile count of None means the tileset has no end.
+DEFAULT_TILESETS = (
+    (1, 'TILE_A.tsx', 'tiles', 0, None),
+    (COLLISION_TILESET_OFFSET, 'collision.tsx', 'collision', 0, None),
+)
+
+@contextlib.contextmanager
+def open_map_sections(sourcefile):
+    # memory-maps a .map file and yields a dict of its sections.
+    # array sections are zero-copy short views, only valid inside the with block.
+    if os.path.getsize(sourcefile) < MAP_FILE_SIZE:
+        fail('%s is too small to be a map file.' % sourcefile)
+
+    f = open(sourcefile, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buf = memoryview(mm)
+    sections = {}
+    try:
+        for name, offset, size in MAP_SECTIONS:
+            sections[name] = buf[offset:offset+size*2].cast('h')
+        for name, offset in MAP_INTS:
+            sections[name] = buf[offset:offset+4].cast('i')[0]
+        yield sections
+    finally:
+        for name, offset, size in MAP_SECTIONS:
+            if name in sections: sections[name].release()
+        buf.release()
+        try:
+            mm.close()
+        except BufferError:
+            # a view escaped (e.g. held by a traceback). it is closed when collected.
+            pass
+        f.close()
+
+@contextlib.contextmanager
+def open_map_source(filename, settings):
+    # yields the sections of an original map, from the pack archive with --from-pack.
+    if not settings.from_pack:
+        with open_map_sections('%s/%s.map' % (settings.original_maps_dir, filename)) as sections:
+            yield sections
+        return
+    with profile_stage('unpack map'):
+        data = read_packed_map(settings.pack_prefix, read_pack_index(settings.pack_prefix), filename)
+    yield RabiRibiMap.from_bytes(data).sections()
 
 def transpose_d2l(data):
-    x = [data[i::200] for i in range(200)]
-    return [x for x in x for x in x] # flatten list
+    return list(chain.from_iterable(data[i::200] for i in range(200)))
 
 def transpose_l2d(data):
-    x = [data[i::500] for i in range(500)]
-    return [x for x in x for x in x] # flatten list
-
-def collision_data_to_layer(data, name):
-    def idmap(i):
-        if i == 0: return 0
-        return i + COLLISION_TILESET_OFFSET
-
-    return {
+    return list(chain.from_iterable(data[i::500] for i in range(500)))
+
+def make_short_table(idmap):
+    # lookup table for every signed short value. negative values index from the end.
+    return [idmap(i - 65536 if i >= 32768 else i) for i in range(65536)]
+
+def collision_id_to_gid(i):
+    if i == 0: return 0
+    return i + COLLISION_TILESET_OFFSET
+
+def tile_id_to_gid(i, tilesets=DEFAULT_TILESETS):
+    # returns None for tiles that are in none of the tilesets.
+    if i == 0: return 0
+    actualid = 0
+    if i < 0:
+        actualid += 0x80000000
+        i = -i
+    if i >= 5000:
+        actualid += 0x40000000
+        i -= 5000
+    i -= 2*(i//32)
+    for first_gid, source, kind, tile_offset, tile_count in tilesets:
+        if kind == 'tiles' and tile_offset <= i and (tile_count == None or i < tile_offset + tile_count):
+            return actualid + i - tile_offset + first_gid
+    return None
+
+@functools.lru_cache(maxsize=None)
+def collision_gid_table():
+    return make_short_table(collision_id_to_gid)
+
+@functools.lru_cache(maxsize=None)
+def tile_gid_table(tilesets=DEFAULT_TILESETS):
+    return make_short_table(lambda i: tile_id_to_gid(i, tilesets))
+
+# tiled layer data encodings, as (encoding, compression)
+LAYER_ENCODINGS = {
+    'array': (None, None),
+    'base64': ('base64', None),
+    'base64-zlib': ('base64', 'zlib'),
+    'base64-gzip': ('base64', 'gzip'),
+    'base64-zstd': ('base64', 'zstd'),
+}
+# tiled stores base64 layer data as little-endian unsigned 32-bit gids.
+UINT32 = 'I' if array('I').itemsize == 4 else 'L'
+
+def zstd_module():
+    try:
+        from compression import zstd # python 3.14+
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        fail('zstd layer compression needs Python 3.14 or the zstandard package (pip install zstandard).')
+
+def compress_layer_bytes(raw, compression):
+    if compression == None: return raw
+    if compression == 'zlib': return zlib.compress(raw)
+    if compression == 'gzip': return gzip.compress(raw, mtime=0)
+    if compression == 'zstd': return zstd_module().compress(raw)
+    fail('Unknown layer compression: %s' % compression)
+
+def decompress_layer_bytes(raw, compression):
+    if compression == None or compression == '': return raw
+    if compression == 'zlib': return zlib.decompress(raw)
+    if compression == 'gzip': return gzip.decompress(raw)
+    if compression == 'zstd':
+        zstd = zstd_module()
+        try:
+            return zstd.decompress(raw)
+        except zstd.ZstdError as e:
+            raise ValueError(e)
+    raise ValueError('unsupported compression "%s"' % compression)
+
+def encode_gids(gids, encoding):
+    # the data member of a tiled layer or chunk holding gids, in the given LAYER_ENCODINGS format.
+    layer_encoding, compression = LAYER_ENCODINGS[encoding]
+    if layer_encoding == None:
+        return gids
+    packed = array(UINT32, gids)
+    if sys.byteorder == 'big': packed.byteswap()
+    return base64.b64encode(compress_layer_bytes(packed.tobytes(), compression)).decode('ascii')
+
+def encode_layer_data(layer, gids, encoding):
+    # sets the data of a tiled tile layer in the given LAYER_ENCODINGS format.
+    set_layer_encoding(layer, encoding)
+    layer['data'] = encode_gids(gids, encoding)
+    return layer
+
+def set_layer_encoding(layer, encoding):
+    layer_encoding, compression = LAYER_ENCODINGS[encoding]
+    if layer_encoding != None: layer['encoding'] = layer_encoding
+    if compression != None: layer['compression'] = compression
+
+def decode_gids(data, encoding, compression):
+    if encoding == 'csv' and not isinstance(data, str):
+        return data
+    if encoding != 'base64':
+        raise ValueError('unsupported encoding "%s"' % encoding)
+    raw = decompress_layer_bytes(base64.b64decode(data), compression)
+    gids = array(UINT32)
+    gids.frombytes(raw)
+    if sys.byteorder == 'big': gids.byteswap()
+    return gids
+
+def decode_layer_data(layer):
+    # returns the gids of a tiled tile layer, in whichever encoding it was saved.
+    encoding = layer.get('encoding', 'csv')
+    compression = layer.get('compression')
+    if 'chunks' not in layer:
+        return decode_gids(layer['data'], encoding, compression)
+
+    # infinite maps store their tiles in chunks. tiled may save chunks that reach past the
+    # edges of the map. tiles there are ignored.
+    gids = array(UINT32, bytes(array(UINT32).itemsize * 500*200))
+    for chunk in layer['chunks']:
+        chunk_gids = decode_gids(chunk['data'], encoding, compression)
+        x, y, width, height = chunk['x'], chunk['y'], chunk['width'], chunk['height']
+        if len(chunk_gids) != width*height:
+            raise ValueError('chunk at %d, %d has %d tiles instead of %d' % (x, y, len(chunk_gids), width*height))
+        left, right = max(0, x), min(500, x + width)
+        for row in range(height):
+            row_gids = chunk_gids[row*width:(row+1)*width]
+            inside = 0 <= y + row < 200 and left < right
+            if inside:
+                try:
+                    gids[(y+row)*500 + left:(y+row)*500 + right] = array(UINT32, row_gids[left-x:right-x])
+                except (TypeError, OverflowError):
+                    raise ValueError('chunk at %d, %d has invalid tile data' % (x, y))
+            if inside and left == x and right == x + width: continue
+            for i in compress(range(width), row_gids):
+                if not inside or not left <= x + i < right:
+                    warn('%s(%d,%d) : Tile outside the map. It will be ignored.' % (layer.get('name'), x + i, y + row),
+                        'tile-outside-map', layer.get('name'), x + i, y + row)
+    return gids
+
+def room_top(row):
+    # the y tile coordinate where a row of rooms starts. every fourth row is 12 tiles tall, not 11.
+    return 11*row + (row+3)//4
+
+# (x, y, width, height) of the chunks of an infinite tiled map, one per room.
+ROOM_CHUNKS = tuple((20*x, room_top(y), 20, min(200, room_top(y+1)) - room_top(y)) for y in range(18) for x in range(25))
+
+def make_tile_layer(gids, name, encoding, chunked=False):
+    layer = {
         "width": 500,
         "height": 200,
         "x": 0,
@@ -111,10 +533,44 @@ def collision_data_to_layer(data, name):
         "visible": True,
         "opacity": 1,
         "name": name,
-        "data": transpose_d2l([idmap(i) for i in data])
     }
-
-def object_data_to_layer(data, name, color):
+    if not chunked:
+        return encode_layer_data(layer, gids, encoding)
+
+    layer['startx'] = 0
+    layer['starty'] = 0
+    set_layer_encoding(layer, encoding)
+    chunks = []
+    for x, y, width, height in ROOM_CHUNKS:
+        chunk_gids = list(chain.from_iterable(gids[row*500 + x:row*500 + x + width] for row in range(y, y + height)))
+        if not any(chunk_gids): continue
+        chunks.append({
+            "x": x,
+            "y": y,
+            "width": width,
+            "height": height,
+            "data": encode_gids(chunk_gids, encoding),
+        })
+    layer['chunks'] = chunks
+    return layer
+
+def collision_data_to_layer(data, name, encoding='array', chunked=False):
+    return make_tile_layer(list(map(collision_gid_table().__getitem__, transpose_d2l(data))), name, encoding, chunked)
+
+def nonzero_cells(data):
+    # sparse {index: value} of the nonzero cells of a section, in index order.
+    return dict((i, data[i]) for i in compress(range(len(data)), data))
+
+def scatter_cells(cells, size):
+    # packs sparse {index: value} cells into the bytes of a section of shorts.
+    buf = bytearray(2*size)
+    view = memoryview(buf).cast('h')
+    for index, value in cells.items():
+        view[index] = value
+    view.release()
+    return buf
+
+def object_data_to_layer(cells, name, color):
     def make_object(index, value):
         return {
             "width": 32,
@@ -123,7 +579,7 @@ def object_data_to_layer(data, name, color):
             "y": 32*(index%200),
             "name": str(value)
         }
-    objects = [make_object(i, o) for i, o in enumerate(data) if o != 0]
+    objects = [make_object(i, o) for i, o in cells.items()]
 
     return {
         "draworder":"topdown",
@@ -137,30 +593,14 @@ def object_data_to_layer(data, name, color):
         "y":0,
     }
 
-def tile_data_to_layer(data, name):
-    def idmap(i):
-        if i == 0: return 0
-        actualid = 0
-        if i < 0:
-            actualid += 0x80000000
-            i = -i
-        if i >= 5000:
-            actualid += 0x40000000
-            i -= 5000
-        i -= 2*(i//32)
-        return actualid + i + 1
-
-    return {
-        "width": 500,
-        "height": 200,
-        "x": 0,
-        "y": 0,
-        "type": "tilelayer",
-        "visible": True,
-        "opacity": 1,
-        "name": name,
-        "data": transpose_d2l([idmap(i) for i in data])
-    }
+def tile_data_to_layer(data, name, encoding='array', chunked=False, tilesets=DEFAULT_TILESETS):
+    gids = list(map(tile_gid_table(tilesets).__getitem__, transpose_d2l(data)))
+    if None in gids:
+        for index in [index for index, gid in enumerate(gids) if gid == None]:
+            x, y = index%500, index//500
+            warn('%s(%d,%d) : Tile %d is in none of the tilesets. It is left empty.' % (name, x, y, data[x*200 + y]), 'tile-outside-tilesets', name, x, y)
+            gids[index] = 0
+    return make_tile_layer(gids, name, encoding, chunked)
 
 def minimap_data_to_layer(data, name, color, visible=True):
     def make_object(index, value):
@@ -189,25 +629,41 @@ def minimap_data_to_layer(data, name, color, visible=True):
     }
 
 def object_layer_to_data(layer_data, layer_name):
-    data = [0]*MAP_SIZE
+    cells = {}
+    names = {}
 
     for item in layer_data['objects']:
+        x, y = int(item['x']//32), int(item['y']//32)
         try:
             value = int(item['name'])
             if item['x']%32 != 0 or item['y']%32 != 0:
                 warn('Object "%s" with invalid coordinates %.2f, %.2f found in layer "%s". Object will be ignored. Please make sure you have "snap to grid" checked.'
-                    % (item['name'], item['x'], item['y'], layer_name))
+                    % (item['name'], item['x'], item['y'], layer_name), 'object-off-grid', layer_name, x, y)
                 continue
-            index = item['x']//32 * 200 + item['y']//32
-            data[index] = value
+            if not (0 <= item['x'] < 32*500 and 0 <= item['y'] < 32*200):
+                warn('Object "%s" at position %.2f, %.2f in layer "%s" is outside the map. Object will be ignored.'
+                    % (item['name'], item['x'], item['y'], layer_name), 'object-outside-map', layer_name, x, y)
+                continue
+            if not -32768 <= value < 32768:
+                warn('Object with out of range name "%s" at position %.2f, %.2f in layer "%s". Object will be ignored.'
+                    % (item['name'], item['x'], item['y'], layer_name), 'object-out-of-range', layer_name, x, y)
+                continue
+            index = x*200 + y
+            if index in cells:
+                warn('Objects "%s" and "%s" are both at position %.2f, %.2f in layer "%s". Only "%s" will be used.'
+                    % (names[index], item['name'], item['x'], item['y'], layer_name, item['name']), 'object-duplicate', layer_name, x, y)
+            cells[index] = value
+            names[index] = item['name']
         except ValueError as e:
             warn('Object with invalid name "%s" at position %.2f, %.2f in layer "%s". Object will be ignored.'
-                % (item['name'], item['x'], item['y'], layer_name))
+                % (item['name'], item['x'], item['y'], layer_name), 'object-invalid-name', layer_name, x, y)
 
-    return data
+    return cells
 
 def minimap_layer_to_data(layer_data, layer_name):
+    # every problem in the layer is found before failing.
     data = [None]*MINIMAP_SIZE
+    errors = []
 
     def fail_details(item, message):
         x = '?'
@@ -216,7 +672,7 @@ def minimap_layer_to_data(layer_data, layer_name):
         if 'y' in item: y = '%.2f' % item['y']
         name = '?'
         if 'name' in item: name = item['name']
-        fail('Minimap layer "%s", object "%s" at %s, %s: %s' % (layer_name, name, x, y, message))
+        errors.append('Minimap layer "%s", object "%s" at %s, %s: %s' % (layer_name, name, x, y, message))
 
 
     for item in layer_data['objects']:
@@ -224,89 +680,94 @@ def minimap_layer_to_data(layer_data, layer_name):
             value = int(item['name'])
             if item['x']%32 != 0 or item['y']%32 != 0:
                 fail_details(item, 'Minimap tile object not positioned correctly.')
+                continue
+            if not -32768 <= value < 32768:
+                fail_details(item, 'Minimap tile name is out of range.')
+                continue
             x = item['x']//640
             y = item['y']//32
             y = 4*(y//45) + max(0,y%45-1)//11
+            if not (0 <= x < MINIMAP_SIZE//18 and 0 <= y < 18):
+                fail_details(item, 'Minimap tile object is outside the map.')
+                continue
             index = x*18 + y
             if data[index] != None:
                 fail_details(item, 'Duplicate minimap tile object.')
+                continue
             data[index] = value
         except ValueError as e:
             fail_details(item, 'Minimap tile name needs to be a number.')
 
-    for i, val in enumerate(data):
-        if val == None:
-            x, y = i//18, i%18
-            fail('Layer %s\'s map tile at (%d, %d) is missing.' % (layer_name, x, y))
+    missing = [i for i, val in enumerate(data) if val == None]
+    if len(missing) == 1:
+        errors.append('Layer %s\'s map tile at (%d, %d) is missing.' % (layer_name, missing[0]//18, missing[0]%18))
+    elif missing:
+        shown = ', '.join('(%d, %d)' % (i//18, i%18) for i in missing[:DIAGNOSTIC_SAMPLES])
+        more = ' and %d more' % (len(missing) - DIAGNOSTIC_SAMPLES) if len(missing) > DIAGNOSTIC_SAMPLES else ''
+        errors.append('Layer %s\'s map tiles at %s%s are missing.' % (layer_name, shown, more))
 
+    fail_all(errors)
     return data
 
 def map_to_json(filename, settings):
     print('Converting Original map file -> Json : %s' % filename)
-    # location of source map file
-    sourcefile = "%s/%s.map" % (settings.original_maps_dir, filename)
+    # location of target json file
     targetfile = "%s/%s.json" % (settings.editable_maps_dir, filename)
     
     # LOADING MAP DATA
-    f = open(sourcefile, "rb")
-    f.seek(ARRAY_MAP)
-    tiledata_map = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    f.seek(ARRAY_EVENT)
-    tiledata_event = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    f.seek(ARRAY_ITEMS)
-    tiledata_items = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    
-    f.seek(ARRAY_ROOMTYPE)
-    tiledata_roomtype = list(struct.unpack('%dh' % MINIMAP_SIZE, f.read(MINIMAP_SIZE*2)))
-    f.seek(ARRAY_ROOMCOLOR)
-    tiledata_roomcolor = list(struct.unpack('%dh' % MINIMAP_SIZE, f.read(MINIMAP_SIZE*2)))
-    f.seek(ARRAY_ROOMBG)
-    tiledata_roombg = list(struct.unpack('%dh' % MINIMAP_SIZE, f.read(MINIMAP_SIZE*2)))
-    
-    f.seek(INT_AREA)
-    metadata_area = list(struct.unpack('i', f.read(4)))[0]
-    
-    f.seek(ARRAY_TILES_0)
-    tiledata_tiles0 = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    f.seek(ARRAY_TILES_1)
-    tiledata_tiles1 = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    f.seek(ARRAY_TILES_2)
-    tiledata_tiles2 = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    f.seek(ARRAY_TILES_3)
-    tiledata_tiles3 = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    f.seek(ARRAY_TILES_4)
-    tiledata_tiles4 = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    f.seek(ARRAY_TILES_5)
-    tiledata_tiles5 = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    f.seek(ARRAY_TILES_6)
-    tiledata_tiles6 = list(struct.unpack('%dh' % MAP_SIZE, f.read(MAP_SIZE*2)))
-    
-    f.seek(INT_VERSION)
-    metadata_version = list(struct.unpack('i', f.read(4)))[0]
-    f.close()
+    with open_map_source(filename, settings) as sections:
+        with profile_stage('read map'):
+            data, layers = map_sections_to_tiled(sections, settings.layer_encoding, settings.chunked, map_tilesets(settings))
 
+        f = open(targetfile, 'w+')
+        try:
+            with profile_stage('write json'):
+                write_json_stream(f, data, 'layers', layers)
+        except BaseException:
+            # do not leave a truncated json file behind.
+            f.close()
+            os.remove(targetfile)
+            raise
+        f.close()
+
+def map_sections_to_tiled(sections, layer_encoding='array', chunked=False, tilesets=DEFAULT_TILESETS):
+    # returns the tiled map header and a generator of its layers. sections maps section
+    # names (see MAP_SECTIONS and MAP_INTS) to their values. each layer is only built when
+    # the generator reaches it, so sections must stay valid until then. tilesets are laid
+    # out like DEFAULT_TILESETS.
+    metadata_area = sections['area']
+    metadata_version = sections['version']
+
+    tiledata_event = nonzero_cells(sections['event'])
     extracted_metadata, new_tiledata_event = extract_encoded_metadata(tiledata_event)
     bunmania_mode = (extracted_metadata['bm_name'] != '')
     if bunmania_mode:
         tiledata_event = new_tiledata_event
 
     # layer draw order: 0 3 4 1 5 6 2
-    layers = [
-        collision_data_to_layer(tiledata_map, "collision"),
-        tile_data_to_layer(tiledata_tiles0, "tiles0"),
-        tile_data_to_layer(tiledata_tiles3, "tiles3"),
-        tile_data_to_layer(tiledata_tiles4, "tiles4"),
-        tile_data_to_layer(tiledata_tiles1, "tiles1"),
-        tile_data_to_layer(tiledata_tiles5, "tiles5"),
-        tile_data_to_layer(tiledata_tiles6, "tiles6"),
-        tile_data_to_layer(tiledata_tiles2, "tiles2"),
-        object_data_to_layer(tiledata_event, "event", "#8080ff"),
-        object_data_to_layer(tiledata_items, "items", "#ff6000"),
-        minimap_data_to_layer(tiledata_roomtype, "roomtype", "#00ffff", visible=False),
-        minimap_data_to_layer(tiledata_roomcolor, "roomcolor", "#ffff00", visible=False),
-        minimap_data_to_layer(tiledata_roombg, "roombg", "#00ff00", visible=False),
+    layer_builders = [
+        (collision_data_to_layer, sections['collision'], "collision", layer_encoding, chunked),
+        (tile_data_to_layer, sections['tiles0'], "tiles0", layer_encoding, chunked, tilesets),
+        (tile_data_to_layer, sections['tiles3'], "tiles3", layer_encoding, chunked, tilesets),
+        (tile_data_to_layer, sections['tiles4'], "tiles4", layer_encoding, chunked, tilesets),
+        (tile_data_to_layer, sections['tiles1'], "tiles1", layer_encoding, chunked, tilesets),
+        (tile_data_to_layer, sections['tiles5'], "tiles5", layer_encoding, chunked, tilesets),
+        (tile_data_to_layer, sections['tiles6'], "tiles6", layer_encoding, chunked, tilesets),
+        (tile_data_to_layer, sections['tiles2'], "tiles2", layer_encoding, chunked, tilesets),
+        (object_data_to_layer, tiledata_event, "event", "#8080ff"),
+        (object_data_to_layer, nonzero_cells(sections['items']), "items", "#ff6000"),
+        (minimap_data_to_layer, sections['roomtype'], "roomtype", "#00ffff", False),
+        (minimap_data_to_layer, sections['roomcolor'], "roomcolor", "#ffff00", False),
+        (minimap_data_to_layer, sections['roombg'], "roombg", "#00ff00", False),
     ]
+    layers = (profiled('build %s' % args[1], build, *args) for build, *args in layer_builders)
+
+    data = make_tiled_header(metadata_area, metadata_version, extracted_metadata if bunmania_mode else None, tilesets)
+    if chunked: data['infinite'] = True
+    return data, layers
 
+def make_tiled_header(area, version, bunmania_metadata=None, tilesets=DEFAULT_TILESETS):
+    # the tiled map document, without its layers.
     data = {
         "width": 500,
         "height": 200,
@@ -317,17 +778,13 @@ def map_to_json(filename, settings):
         "tiledversion":"1.0.2402",
         "tilesets":[
             {
-             "firstgid": 1,
-             "source":"TILE_A.tsx",
-            }, 
-            {
-             "firstgid":COLLISION_TILESET_OFFSET,
-             "source":"collision.tsx",
-            }],
+             "firstgid": first_gid,
+             "source": source,
+            } for first_gid, source, kind, tile_offset, tile_count in tilesets],
         "properties":
             {
-             "area": metadata_area,
-             "version": metadata_version,
+             "area": area,
+             "version": version,
              "bunmania": False,
 
              "bm_name": 'untitled',
@@ -360,35 +817,47 @@ def map_to_json(filename, settings):
             },
         "type":"map",
         "version":1,
-        "layers": layers,
     }
 
-    if bunmania_mode:
+    if bunmania_metadata != None:
         properties = data['properties']
-        for key, value in extracted_metadata.items():
+        for key, value in bunmania_metadata.items():
             if value != None: properties[key] = value
         properties['bunmania'] = True
 
+    return data
 
-    f = open(targetfile, 'w+')
-    f.write(json.dumps(data))
-    f.close()
+def write_json_stream(f, document, key, values):
+    # writes document with document[key] set to the list of values, serializing and writing
+    # each value as it is produced. the output is byte-identical to json.dumps() of the full
+    # document with key as its last member.
+    head = json.dumps(document)
+    f.write(head[:-1] + ', ' if document else '{')
+    f.write(json.dumps(key) + ': [')
+    for i, value in enumerate(values):
+        if i > 0: f.write(', ')
+        f.write(json.dumps(value))
+    f.write(']}')
 
 def read_metadata(properties, property_types):
+    # returns the metadata and the errors found reading it. properties with the wrong type are
+    # left out of the metadata, so the values of the others can still be checked.
     metadata = {}
+    errors = []
 
     def set_metadata(property_name, value):
         metadata[property_name] = value
 
     def get_property(property_name, property_type, default_value):
         if property_name not in properties:
-            warn('bunmania property %s (%s) not found. using default value of %s' % (property_name, property_type, default_value))
+            warn('bunmania property %s (%s) not found. using default value of %s' % (property_name, property_type, default_value), 'bunmania-property-missing')
             return set_metadata(property_name, default_value)
         if property_name not in property_types:
-            warn('bunmania property %s (%s) not found. using default value of %s' % (property_name, property_type, default_value))
+            warn('bunmania property %s (%s) not found. using default value of %s' % (property_name, property_type, default_value), 'bunmania-property-missing')
             return set_metadata(property_name, default_value)
         if property_types[property_name] != property_type:
-            fail('bunmania property %s has wrong type. should be %s, not %s' % (property_name, property_type, property_types[property_name]))
+            errors.append('bunmania property %s has wrong type. should be %s, not %s' % (property_name, property_type, property_types[property_name]))
+            return
 
         set_metadata(property_name, properties[property_name])
 
@@ -403,18 +872,21 @@ def read_metadata(properties, property_types):
     get_property('bm_difficulty', 'int', 1)
     get_property('bm_numeggs', 'int', 0)
 
-    return metadata
+    return metadata, errors
 
 def apply_metadata(map_arrays, metadata):
+    # every bad value is found before failing.
+    errors = []
+
     def get_string_data(string_name, string, charlimit):
-        if len(string) > charlimit: fail('%s cannot be longer than %d chars.' % (string_name, charlimit))
-        if not all(ord(c) < 128 for c in string): fail('%s must use only ASCII characters.' % string_name)
+        if len(string) > charlimit: errors.append('%s cannot be longer than %d chars.' % (string_name, charlimit))
+        if not all(ord(c) < 128 for c in string): errors.append('%s must use only ASCII characters.' % string_name)
 
         return (5000+ord(c) for c in string)
 
     def get_time_data(time_name, time_value):
-        if time_value <= 0: fail('Time %s cannot be negative or zero.' % time_name)
-        if time_value >= 3600: fail('Time %s exceeds 60 minutes.' % time_name)
+        if time_value <= 0: errors.append('Time %s cannot be negative or zero.' % time_name)
+        if time_value >= 3600: errors.append('Time %s exceeds 60 minutes.' % time_name)
 
         mins = int(time_value//60)
         secs = int(time_value%60)
@@ -428,27 +900,32 @@ def apply_metadata(map_arrays, metadata):
     def get_int_data(int_name, int_value):
         return (5000+int_value,)
 
-    def write_into_row(row, data):
-        for x, v in enumerate(data):
+    def write_into_row(row, property_name, get_data):
+        # properties missing from metadata had the wrong type, and have been reported already.
+        if property_name not in metadata: return
+        for x, v in enumerate(get_data(metadata[property_name])):
             map_arrays['event'][row+200*x] = v
 
-    write_into_row(0, get_string_data('map name', metadata['bm_name'], 32))
-    write_into_row(1, get_string_data('author name', metadata['bm_author'], 16))
+    write_into_row(0, 'bm_name', lambda v: get_string_data('map name', v, 32))
+    write_into_row(1, 'bm_author', lambda v: get_string_data('author name', v, 16))
     
-    write_into_row(2, get_time_data('par5 (bronze)', metadata['bm_par5']))
-    write_into_row(3, get_time_data('par4 (silver)', metadata['bm_par4']))
-    write_into_row(4, get_time_data('par3 (gold)', metadata['bm_par3']))
-    write_into_row(5, get_time_data('par2 (platinum)', metadata['bm_par2']))
-    write_into_row(6, get_time_data('par1 (rainbow)', metadata['bm_par1']))
+    write_into_row(2, 'bm_par5', lambda v: get_time_data('par5 (bronze)', v))
+    write_into_row(3, 'bm_par4', lambda v: get_time_data('par4 (silver)', v))
+    write_into_row(4, 'bm_par3', lambda v: get_time_data('par3 (gold)', v))
+    write_into_row(5, 'bm_par2', lambda v: get_time_data('par2 (platinum)', v))
+    write_into_row(6, 'bm_par1', lambda v: get_time_data('par1 (rainbow)', v))
+
+    write_into_row(7, 'bm_fullexp', lambda v: get_bool_data('full exp', v))
 
-    write_into_row(7, get_bool_data('full exp', metadata['bm_fullexp']))
+    write_into_row(8, 'bm_difficulty', lambda v: get_int_data('difficulty', v))
+    write_into_row(9, 'bm_numeggs', lambda v: get_int_data('number of eggs', v))
 
-    write_into_row(8, get_int_data('difficulty', metadata['bm_difficulty']))
-    write_into_row(9, get_int_data('number of eggs', metadata['bm_numeggs']))
+    fail_all(errors)
 
 
 def extract_encoded_metadata(tiledata_event):
-    new_tiledata_event = tiledata_event[:]
+    # tiledata_event holds the sparse {index: value} cells of the event layer.
+    new_tiledata_event = dict(tiledata_event)
     metadata = {}
 
     def decode_string_data(data):
@@ -475,13 +952,13 @@ def extract_encoded_metadata(tiledata_event):
     def get_raw_data(row, length, blanks_as_spaces=False):
         data = []
         for x in range(length):
-            v = tiledata_event[row+200*x]
+            v = tiledata_event.get(row+200*x, 0)
             if v < 5000:
                 if blanks_as_spaces:
                     v = 5032
                 else:
                     break
-            new_tiledata_event[row+200*x] = 0
+            new_tiledata_event.pop(row+200*x, None)
             data.append(v)
         return data
 
@@ -502,151 +979,1890 @@ def extract_encoded_metadata(tiledata_event):
     return metadata, new_tiledata_event
     
 
-def convert_to_ranges(first_gids):
-    gid_list = list(first_gids.values())
-    gid_ranges = {}
-    for gid_name in first_gids.keys():
-        first_gid = first_gids[gid_name]
-        end_gid = min([INF] + [gid for gid in gid_list if gid > first_gid])
-        gid_ranges[gid_name] = (first_gid, end_gid-first_gid)
-    return gid_ranges
-
-
-def json_to_map(filename, settings):
-    print('Converting Json -> Final map file : %s' % filename)
-    # location of source map file
-    basemapfile = "%s/%s.map" % (settings.original_maps_dir, filename)
-    sourcefile = "%s/%s.json" % (settings.editable_maps_dir, filename)
-    targetfile = "%s/%s.map" % (settings.final_maps_dir, filename)
-    shutil.copyfile(basemapfile, targetfile)
-
-    f = open(sourcefile)
-    jsondata = json.loads(f.read())
-    f.close()
+def read_tileset(tsx_path):
+    # reads the tile size, layout, custom properties and image of a tiled .tsx tileset.
+    if not os.path.isfile(tsx_path): fail('The tileset %s was not found.' % tsx_path)
+    try:
+        root = ElementTree.parse(tsx_path).getroot()
+    except ElementTree.ParseError as e:
+        fail('Could not read the tileset %s: %s' % (tsx_path, e))
+    tileset = dict((key, int(root.get(key, 0))) for key in ('tilewidth', 'tileheight', 'spacing', 'margin', 'columns', 'tilecount'))
+    tileset['properties'] = dict((prop.get('name'), prop.get('value')) for prop in root.iterfind('properties/property'))
+    image = root.find('image')
+    tileset['image'] = None if image == None else os.path.join(os.path.dirname(tsx_path), image.get('source'))
+    return tileset
+
+def tileset_kind(source):
+    if 'collision' in source: return 'collision'
+    if 'TILE_A' in source: return 'tiles'
+    return None
+
+def read_tileset_ref(tileset, tileset_dir):
+    # returns the source, kind, tile offset and tile count of a tileset of a tiled map. split
+    # tilesets set their tile offset with a tile_offset property, on the tileset in tiled or in
+    # its .tsx file. .tsx files are only read if tileset_dir is given and they exist.
+    source = tileset.get('source', tileset.get('name', ''))
+    properties = tileset.get('properties', {})
+    if isinstance(properties, list):
+        properties = dict((prop['name'], prop['value']) for prop in properties)
+    tile_count = tileset.get('tilecount')
+    tsx_path = None if tileset_dir == None or 'source' not in tileset else os.path.join(tileset_dir, source)
+    if tsx_path != None and os.path.isfile(tsx_path):
+        tsx = read_tileset(tsx_path)
+        properties = tsx['properties']
+        tile_count = tsx['tilecount'] or None
+
+    tile_offset = properties.get('tile_offset', 0)
+    try:
+        tile_offset = int(tile_offset)
+    except ValueError:
+        fail('The tile_offset of tileset %s must be a number, not "%s".' % (source, tile_offset))
+    return source, tileset_kind(source), tile_offset, tile_count
+
+def make_gid_index(tilesets):
+    # returns the sorted (first gid, end gid, kind, tile offset) ranges of tilesets, given as
+    # (firstgid, source, kind, tile offset, tile count). like in tiled, a tileset's gids end at
+    # its last tile, or at the first gid of the next tileset if its tile count is not known.
+    tilesets = sorted(tilesets)
+    gid_index = []
+    covered = []
+    for k, (first_gid, source, kind, tile_offset, tile_count) in enumerate(tilesets):
+        end_gid = tilesets[k+1][0] if k+1 < len(tilesets) else INF
+        if tile_count != None: end_gid = min(end_gid, first_gid + tile_count)
+        gid_index.append((first_gid, end_gid, kind, tile_offset))
+        if kind != None: covered.append((kind, tile_offset, tile_offset + end_gid - first_gid, source))
+
+    # tilesets of the same kind must not hold the same tiles.
+    covered.sort()
+    for (kind, start, end, source), (next_kind, next_start, next_end, next_source) in zip(covered, covered[1:]):
+        if kind == next_kind and next_start < end:
+            fail('The tilesets %s and %s both hold tile %d. Give split tilesets a tile_offset property with the index of their first tile.' % (source, next_source, next_start))
+    return tuple(gid_index)
+
+def tiled_gid_index(jsondata, tileset_dir=None):
+    tilesets = []
+    for tileset in jsondata['tilesets']:
+        source, kind, tile_offset, tile_count = read_tileset_ref(tileset, tileset_dir)
+        tilesets.append((tileset['firstgid'], source, kind, tile_offset, tile_count))
+    return make_gid_index(tilesets)
+
+def split_tilesets(sources, tileset_dir):
+    # the tilesets of maps whose tiles are split across the .tsx files in sources, in that
+    # order. each needs a tilecount, and a tile_offset property unless it starts at tile 0.
+    tilesets = []
+    first_gid = 1
+    for source in sources:
+        if not os.path.isfile(os.path.join(tileset_dir, source)):
+            fail('The tileset %s was not found in %s.' % (source, tileset_dir))
+        source, kind, tile_offset, tile_count = read_tileset_ref({'source': source}, tileset_dir)
+        if tile_count == None: fail('The tileset %s has no tilecount.' % source)
+        tilesets.append((first_gid, source, 'tiles', tile_offset, tile_count))
+        first_gid += tile_count
+    if first_gid > COLLISION_TILESET_OFFSET:
+        fail('The tilesets have %d tiles, but only %d fit before the collision tileset.' % (first_gid - 1, COLLISION_TILESET_OFFSET - 1))
+    tilesets = tuple(tilesets) + DEFAULT_TILESETS[1:]
+    make_gid_index(tilesets)
+    return tilesets
+
+def map_tilesets(settings):
+    # the tilesets map_to_json writes, split as chosen with --tilesets.
+    if not settings.tilesets: return DEFAULT_TILESETS
+    return split_tilesets(settings.tilesets, settings.editable_maps_dir)
+
+def resolve_gids(gid_index, kind, gids):
+    # maps each of gids to its id among the tiles of kind, or None if it is not in a tileset of
+    # that kind. flip bits are ignored. the gids are sorted once, then each tileset range is cut
+    # out of them with bisect.
+    bare_gids = sorted((gid & 0x0000FFFF, gid) for gid in gids)
+    resolved = dict.fromkeys(gids)
+    for first_gid, end_gid, tileset_kind, tile_offset in gid_index:
+        if tileset_kind != kind: continue
+        lo = bisect_left(bare_gids, (first_gid,))
+        hi = bisect_left(bare_gids, (end_gid,))
+        for bare_gid, gid in bare_gids[lo:hi]:
+            resolved[gid] = bare_gid - first_gid + tile_offset
+    return resolved
+
+GID_OK, GID_BAD, GID_FLIPPED = 0, 1, 2
+
+# gid_to_id(i, dataid) functions take a gid and the id resolve_gids found for it.
+
+def collision_gid_to_id(i, dataid):
+    if i == 0: return 0, GID_OK
+    if dataid == None: return 0, GID_BAD
+    if i & 0xC0000000 != 0: return dataid, GID_FLIPPED
+    return dataid, GID_OK
+
+def tile_gid_to_id(i, dataid):
+    if i == 0: return 0, GID_OK
+    if dataid == None: return 0, GID_BAD
+    dataid += 2*(dataid//30)
+    if i & 0x40000000 != 0: dataid += 5000
+    if i & 0x80000000 != 0: dataid = -dataid
+    return dataid, GID_OK
+
+@functools.lru_cache(maxsize=None)
+def gid_decoder(gid_to_id, kind, gid_index):
+    # decodes whole layers of gids. every distinct gid is only decoded once per
+    # gid index, so a layer costs a couple of C-level passes over its cells.
+    # gids whose ids do not fit in a short are returned too, as they cannot be packed.
+    ids = {}
+    bad_gids = set()
+    flipped_gids = set()
+    out_of_range_gids = set()
+
+    def find_indices(layer_data, gids):
+        return list(compress(range(len(layer_data)), map(gids.__contains__, layer_data)))
+
+    def decode_layer(layer_data):
+        distinct = set(layer_data)
+        for gid, dataid in resolve_gids(gid_index, kind, distinct.difference(ids)).items():
+            ids[gid], status = gid_to_id(gid, dataid)
+            if status == GID_BAD: bad_gids.add(gid)
+            if status == GID_FLIPPED: flipped_gids.add(gid)
+            if not -32768 <= ids[gid] < 32768: out_of_range_gids.add(gid)
+
+        data = transpose_l2d(list(map(ids.__getitem__, layer_data)))
+
+        # indices are positions in the json (transposed) layer data.
+        layer_bad_gids = distinct & bad_gids
+        layer_flipped_gids = distinct & flipped_gids
+        bad_indices = find_indices(layer_data, layer_bad_gids) if layer_bad_gids else []
+        flipped_indices = find_indices(layer_data, layer_flipped_gids) if layer_flipped_gids else []
+        return data, bad_indices, flipped_indices, sorted(distinct & out_of_range_gids)
+
+    return decode_layer
+
+
+# layers read by json_to_map. any other layer in an editable map is skipped without being parsed.
+CONVERTED_LAYER_NAMES = (
+    'collision', 'tiles0', 'tiles1', 'tiles2', 'tiles3', 'tiles4', 'tiles5', 'tiles6',
+    'event', 'items', 'roomtype', 'roomcolor', 'roombg',
+)
+# top-level members of a tiled map read by json_to_map.
+CONVERTED_MAP_KEYS = ('properties', 'propertytypes', 'tilesets')
+# layer members that can be large. they are only decoded for layers in CONVERTED_LAYER_NAMES.
+DEFERRED_LAYER_KEYS = ('data', 'objects', 'chunks', 'layers')
+
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_STRUCTURE = re.compile(r'["\[\]{}]')
+JSON_DECODER = json.JSONDecoder()
+
+def skip_json_whitespace(s, idx):
+    return JSON_WHITESPACE.match(s, idx).end()
+
+def skip_json_value(s, idx):
+    # returns the end of the json value starting at idx, without building it.
+    c = s[idx:idx+1]
+    if c == '"':
+        return json.decoder.scanstring(s, idx+1)[1]
+    if c != '[' and c != '{':
+        return JSON_DECODER.raw_decode(s, idx)[1]
+    depth = 0
+    while True:
+        m = JSON_STRUCTURE.search(s, idx)
+        if m == None: raise json.JSONDecodeError('Unterminated value', s, idx)
+        c = m.group()
+        if c == '"':
+            idx = json.decoder.scanstring(s, m.end())[1]
+            continue
+        idx = m.end()
+        depth += 1 if c == '[' or c == '{' else -1
+        if depth == 0: return idx
+
+def parse_json_members(s, idx, parse_member):
+    # walks the json object starting at idx. parse_member(key, idx) must consume the
+    # member's value and return the index after it. returns the index after the object.
+    if s[idx:idx+1] != '{': raise json.JSONDecodeError('Expecting object', s, idx)
+    idx = skip_json_whitespace(s, idx+1)
+    if s[idx:idx+1] == '}': return idx+1
+    while True:
+        if s[idx:idx+1] != '"': raise json.JSONDecodeError('Expecting property name enclosed in double quotes', s, idx)
+        key, idx = json.decoder.scanstring(s, idx+1)
+        idx = skip_json_whitespace(s, idx)
+        if s[idx:idx+1] != ':': raise json.JSONDecodeError("Expecting ':' delimiter", s, idx)
+        idx = parse_member(key, skip_json_whitespace(s, idx+1))
+        idx = skip_json_whitespace(s, idx)
+        c = s[idx:idx+1]
+        if c == '}': return idx+1
+        if c != ',': raise json.JSONDecodeError("Expecting ',' delimiter", s, idx)
+        idx = skip_json_whitespace(s, idx+1)
+
+def parse_json_elements(s, idx, parse_element):
+    # walks the json array starting at idx, like parse_json_members.
+    if s[idx:idx+1] != '[': raise json.JSONDecodeError('Expecting array', s, idx)
+    idx = skip_json_whitespace(s, idx+1)
+    if s[idx:idx+1] == ']': return idx+1
+    while True:
+        idx = skip_json_whitespace(s, parse_element(idx))
+        c = s[idx:idx+1]
+        if c == ']': return idx+1
+        if c != ',': raise json.JSONDecodeError("Expecting ',' delimiter", s, idx)
+        idx = skip_json_whitespace(s, idx+1)
+
+def decode_json_int_array(s, start):
+    # decodes a json array of integers into a compact buffer. the intermediate list only
+    # lives for one layer at a time.
+    values = JSON_DECODER.raw_decode(s, start)[0]
+    try:
+        return array('q', values)
+    except (TypeError, OverflowError):
+        # not a plain array of integers. leave it to the layer decoder to complain about.
+        return values
+
+def parse_tiled_json(s, layer_names=CONVERTED_LAYER_NAMES):
+    # parses a tiled map, only materializing the members json_to_map reads and the
+    # layers named in layer_names. other layers are skipped over without being built.
+    jsondata = {}
+    layers = []
+
+    def parse_layer(idx):
+        layer = {}
+        deferred = {}
+        def parse_layer_member(key, idx):
+            if key in DEFERRED_LAYER_KEYS:
+                end = skip_json_value(s, idx)
+                deferred[key] = (idx, end)
+                return end
+            layer[key], idx = JSON_DECODER.raw_decode(s, idx)
+            return idx
+        idx = parse_json_members(s, idx, parse_layer_member)
+
+        if layer.get('name') in layer_names:
+            for key, (start, end) in deferred.items():
+                if key == 'data' and s[start] == '[':
+                    layer[key] = decode_json_int_array(s, start)
+                else:
+                    layer[key] = JSON_DECODER.raw_decode(s, start)[0]
+            layers.append(layer)
+        return idx
+
+    def parse_map_member(key, idx):
+        if key == 'layers':
+            return parse_json_elements(s, idx, parse_layer)
+        if key in CONVERTED_MAP_KEYS:
+            jsondata[key], idx = JSON_DECODER.raw_decode(s, idx)
+            return idx
+        return skip_json_value(s, idx)
+
+    idx = parse_json_members(s, skip_json_whitespace(s, 0), parse_map_member)
+    if skip_json_whitespace(s, idx) != len(s): raise json.JSONDecodeError('Extra data', s, idx)
+    jsondata['layers'] = layers
+    return jsondata
+
+def tiled_to_map_arrays(jsondata, layer_names=CONVERTED_LAYER_NAMES, tileset_dir=None):
+    # decodes the layers of a tiled map into lists of shorts, keyed by section name. event and
+    # items are sparse {index: value} dicts. minimap sections are None if their layer is missing.
+    # only the sections in layer_names are decoded. bunmania metadata belongs to the event section.
+    # the .tsx files of split tilesets are read from tileset_dir.
+    missing = [key for key in ('properties', 'tilesets') if key not in jsondata]
+    if 'properties' in jsondata and 'bunmania' in jsondata['properties'] and 'propertytypes' not in jsondata:
+        missing.append('propertytypes')
+    fail_all(['The map has no "%s". Save it from Tiled again, or copy it from a json made with --map-to-json.' % key for key in missing])
 
     bunmania_mode = ('bunmania' in jsondata['properties'] and jsondata['properties']['bunmania'] == True)
+    bunmania_mode = bunmania_mode and 'event' in layer_names
+
+    # errors that only affect one layer or the metadata are collected, so that every error in
+    # the map is reported before the conversion fails.
+    errors = []
+    def collect_error(error, code, layer_name=None):
+        for message in (error.messages if isinstance(error, ConversionError) else [str(error)]):
+            record_diagnostic('error', code, layer_name, sample={'message': message, 'layer': layer_name, 'x': None, 'y': None})
+            errors.append(message)
 
     if bunmania_mode:
-        metadata = read_metadata(jsondata['properties'], jsondata['propertytypes'])
+        metadata, metadata_errors = read_metadata(jsondata['properties'], jsondata['propertytypes'])
+        for message in metadata_errors:
+            collect_error(message, 'bunmania-metadata')
 
-    gid_ranges = {}
-    for tileset in jsondata['tilesets']:
-        if 'TILE_A' in tileset['source']:
-            gid_ranges['tiles'] = tileset['firstgid']
-        if 'collision' in tileset['source']:
-            gid_ranges['collision'] = tileset['firstgid']
-    gid_ranges = convert_to_ranges(gid_ranges)
+    gid_index = tiled_gid_index(jsondata, tileset_dir)
+    gid_kinds = set(kind for first_gid, end_gid, kind, tile_offset in gid_index)
 
     layers = jsondata['layers']
     layers = dict((layer['name'], layer) for layer in layers)
 
-    def warn_index(index, layer_name, message):
+    def warn_index(index, layer_name, code, message):
         x, y = index//200, index%200
-        warn('%s(%d,%d) : %s' % (layer_name, x, y, message))
+        warn('%s(%d,%d) : %s' % (layer_name, x, y, message), code, layer_name, x, y)
         return 0
 
-    def collision_layer_to_data(layer_name, gid_name):
+    def warn_indices(layer_name, problems):
+        # problems are (code, message, sorted indices). warnings are shown in index order, but
+        # only the cells that can be shown are formatted. the rest are only counted.
+        limit = DIAGNOSTIC_SAMPLES if DIAGNOSTICS != None else None
+        shown = sorted(chain.from_iterable(((index, code, message) for index in indices[:limit]) for code, message, indices in problems))
+        for index, code, message in shown:
+            warn_index(index, layer_name, code, message)
+        for code, message, indices in problems:
+            if limit != None and len(indices) > limit:
+                record_diagnostic('warning', code, layer_name, count=len(indices) - limit)
+
+    def layer_to_data(layer_name, gid_name, decode_gid, bad_message, flipped_message=None):
         layer_data = layers[layer_name]
-        first_gid, gid_range = gid_ranges[gid_name]
+        if gid_name not in gid_kinds:
+            fail('The %s tileset was not found. Please add it to the map.' % ('collision.tsx' if gid_name == 'collision' else 'TILE_A.tsx'))
+
+        with profile_stage('decode %s' % layer_name):
+            try:
+                gids = decode_layer_data(layer_data)
+            except (ValueError, zlib.error, EOFError, OSError) as e:
+                fail('Could not read the data of layer "%s": %s' % (layer_name, e))
+            if len(gids) != MAP_SIZE:
+                fail('Layer "%s" has %d tiles instead of %d. The map must be 500 by 200 tiles.' % (layer_name, len(gids), MAP_SIZE))
+            data, bad_indices, flipped_indices, out_of_range_gids = gid_decoder(decode_gid, gid_name, gid_index)(gids)
+            if out_of_range_gids:
+                fail('Layer "%s" has tiles whose ids do not fit in a map: gids %s. Check the tilecount of its tilesets.'
+                    % (layer_name, ', '.join(map(str, out_of_range_gids[:DIAGNOSTIC_SAMPLES]))))
+            if bad_indices or flipped_indices:
+                kind = 'collision-tile' if gid_name == 'collision' else 'tile'
+                warn_indices(layer_name, (
+                    ('bad-%s' % kind, bad_message, bad_indices),
+                    ('flipped-%s' % kind, flipped_message, flipped_indices),
+                ))
+        return data
 
-        def rev_idmap(v):
-            index, i = v
-            if i == 0: return 0
-            dataid = (i&0x0000FFFF) - first_gid
-            if dataid < 0 or dataid >= gid_range:
-                return warn_index(index, layer_name, 'Not a collision tile!')
-            if i & 0xC0000000 != 0:
-                warn_index(index, layer_name, 'Flipped collision tile. Do not flip collision tiles! Flipped collision tiles will be treated as their unflipped versions.')
-            return dataid
+    def collision_layer_to_data(layer_name):
+        return layer_to_data(layer_name, "collision", collision_gid_to_id,
+            'Not a collision tile!',
+            'Flipped collision tile. Do not flip collision tiles! Flipped collision tiles will be treated as their unflipped versions.')
+
+    def tile_layer_to_data(layer_name):
+        return layer_to_data(layer_name, "tiles", tile_gid_to_id, 'Not a tile from the tileset!')
+
+    def object_layer(layer_name):
+        return profiled('decode %s' % layer_name, object_layer_to_data, layers[layer_name], layer_name)
+
+    def minimap_layer(minimap_name):
+        if minimap_name not in layers:
+            warn('Minimap layer "%s" not found. All %s tiles be set to the default value 0.' % (minimap_name, minimap_name), 'minimap-layer-missing', minimap_name)
+            return None
+        return profiled('decode %s' % minimap_name, minimap_layer_to_data, layers[minimap_name], minimap_name)
+
+    layer_decoders = [
+        ("collision", collision_layer_to_data),
+        ("event", object_layer),
+        ("items", object_layer),
+        ("tiles0", tile_layer_to_data),
+        ("tiles3", tile_layer_to_data),
+        ("tiles4", tile_layer_to_data),
+        ("tiles1", tile_layer_to_data),
+        ("tiles5", tile_layer_to_data),
+        ("tiles6", tile_layer_to_data),
+        ("tiles2", tile_layer_to_data),
+        ("roomtype", minimap_layer),
+        ("roomcolor", minimap_layer),
+        ("roombg", minimap_layer),
+    ]
+    map_arrays = {}
+    for layer_name, decode in layer_decoders:
+        if layer_name not in layer_names: continue
+        try:
+            map_arrays[layer_name] = decode(layer_name)
+        except KeyError as e:
+            collect_error('Layer not found: %s. Please create the layer, or check that you have named the layers correctly.' % e, 'layer-missing', layer_name)
+        except ConversionError as e:
+            collect_error(e, 'layer-unreadable', layer_name)
 
-        return transpose_l2d(list(map(rev_idmap, enumerate(layer_data['data']))))
+    if bunmania_mode and 'event' in map_arrays:
+        try:
+            apply_metadata(map_arrays, metadata)
+        except ConversionError as e:
+            collect_error(e, 'bunmania-metadata')
 
-    def tile_layer_to_data(layer_name, gid_name):
-        layer_data = layers[layer_name]
-        first_gid, gid_range = gid_ranges[gid_name]
+    fail_all(errors)
+    return map_arrays
 
-        def rev_idmap(v):
-            index, i = v
-            if i == 0: return 0
-            dataid = (i&0x0000FFFF) - first_gid
-            if dataid < 0 or dataid >= gid_range:
-                return warn_index(index, layer_name, 'Not a tile from the tileset!')
-            dataid += 2*(dataid//30)
-            if i & 0x40000000 != 0: dataid += 5000
-            if i & 0x80000000 != 0: dataid = -dataid
-            return dataid
+def read_tiled_json(sourcefile, layer_names=CONVERTED_LAYER_NAMES):
+    f = open(sourcefile)
+    jsondata = parse_tiled_json(f.read(), layer_names)
+    f.close()
+    return jsondata
 
-        return transpose_l2d(list(map(rev_idmap, enumerate(layer_data['data']))))
+def json_to_map(filename, settings):
+    print('Converting Json -> Final map file : %s' % filename)
+    # location of source map file
+    basemapfile = "%s/%s.map" % (settings.original_maps_dir, filename)
+    sourcefile = "%s/%s.json" % (settings.editable_maps_dir, filename)
+    targetfile = "%s/%s.map" % (settings.final_maps_dir, filename)
+    layer_names = settings.layers or CONVERTED_LAYER_NAMES
+
+    with profile_stage('read maps'):
+        f = open(basemapfile, 'rb')
+        base = f.read()
+        f.close()
+        target = read_built_map(filename, base, settings)
+        if target == None and settings.layers:
+            fail('%s was not built from the current %s, or has been changed since, so --layers cannot update only some of its layers. '
+                'Convert it without --layers first.' % (targetfile, basemapfile))
+
+    with profile_stage('parse json'):
+        jsondata = read_tiled_json(sourcefile, layer_names)
+    with profile_stage('decode layers'):
+        map_arrays = tiled_to_map_arrays(jsondata, layer_names, settings.editable_maps_dir)
+
+    with profile_stage('write map'):
+        buf = bytearray(base if target == None else target)
+        if pack_map_arrays(buf, base, map_arrays) or target == None:
+            write_map_file(targetfile, buf)
+
+def read_built_map(filename, base, settings):
+    # returns the final map left by the last build, if the manifest shows it was built from this
+    # base map and has not been changed since. only then can its sections be reused.
+    targetfile = '%s/%s.map' % (settings.final_maps_dir, filename)
+    entry = read_manifest(settings).get(filename)
+    if entry == None or entry['base'] != hashlib.sha1(base).hexdigest(): return None
+    if not os.path.isfile(targetfile): return None
+    f = open(targetfile, 'rb')
+    target = f.read()
+    f.close()
+    if hashlib.sha1(target).hexdigest() != entry['output']: return None
+    return target
 
+def validate_json(filename, settings):
+    # runs every check json_to_map makes, without reading or writing any map file.
+    print('Validating Json : %s' % filename)
+    sourcefile = "%s/%s.json" % (settings.editable_maps_dir, filename)
+    errors = []
+    if not os.path.isfile('%s/%s.map' % (settings.original_maps_dir, filename)):
+        errors.append('The original map %s/%s.map is missing.' % (settings.original_maps_dir, filename))
     try:
-        map_arrays = {
-            "collision": collision_layer_to_data("collision", "collision"),
-            "event": object_layer_to_data(layers["event"], "event"),
-            "items": object_layer_to_data(layers["items"], "items"),
-            "tiles0": tile_layer_to_data("tiles0", "tiles"),
-            "tiles3": tile_layer_to_data("tiles3", "tiles"),
-            "tiles4": tile_layer_to_data("tiles4", "tiles"),
-            "tiles1": tile_layer_to_data("tiles1", "tiles"),
-            "tiles5": tile_layer_to_data("tiles5", "tiles"),
-            "tiles6": tile_layer_to_data("tiles6", "tiles"),
-            "tiles2": tile_layer_to_data("tiles2", "tiles"),
-        }
-        for minimap_name in ["roomtype", "roomcolor", "roombg"]:
-            if minimap_name in layers:
-                map_arrays[minimap_name] = minimap_layer_to_data(layers[minimap_name], minimap_name)
-            else:
-                warn('Minimap layer "%s" not found. All %s tiles be set to the default value 0.' % (minimap_name, minimap_name))
-                map_arrays[minimap_name] = None
-    except KeyError as e:
-        fail('Layer not found: %s. Please create the layer, or check that you have named the layers correctly.' % e)
+        with profile_stage('parse json'):
+            try:
+                jsondata = read_tiled_json(sourcefile)
+            except ValueError as e:
+                fail('%s is not valid json: %s' % (sourcefile, e))
+        with profile_stage('decode layers'):
+            tiled_to_map_arrays(jsondata, tileset_dir=settings.editable_maps_dir)
+    except ConversionError as e:
+        errors.extend(e.messages)
+    fail_all(errors)
+
+def pack_map_arrays(buf, base, map_arrays):
+    # packs the sections of map_arrays in place into buf, a bytearray holding a whole map.
+    # missing minimaps get the base values. returns the names of the sections that changed.
+    changed = []
+    view = memoryview(buf)
+    for name, offset, size in MAP_SECTIONS:
+        if name not in map_arrays: continue
+        values = map_arrays[name]
+        if values == None:
+            packed = memoryview(base)[offset:offset+size*2].cast('h')
+        elif isinstance(values, dict):
+            packed = memoryview(scatter_cells(values, size)).cast('h')
+        else:
+            packed = array('h', values)
+        section = view[offset:offset+size*2].cast('h')
+        if section != packed:
+            section[:] = packed
+            changed.append(name)
+        section.release()
+    view.release()
+    return changed
+
+def write_map_file(targetfile, data):
+    # writes a whole map to a temporary file and renames it over targetfile, so the game
+    # never loads a half-written map.
+    tmpfile = '%s.tmp' % targetfile
+    f = open(tmpfile, 'wb')
+    try:
+        f.write(data)
+        f.close()
+    except BaseException:
+        f.close()
+        os.remove(tmpfile)
+        raise
+    os.replace(tmpfile, targetfile)
+
+class RabiRibiMap(object):
+    # an in-memory .map file. every section in MAP_SECTIONS is an array('h') attribute,
+    # and every field in MAP_INTS an int attribute.
+    __slots__ = tuple(name for name, offset, size in MAP_SECTIONS) + tuple(name for name, offset in MAP_INTS)
+
+    def __init__(self):
+        for name, offset, size in MAP_SECTIONS:
+            setattr(self, name, array('h', bytes(size*2)))
+        for name, offset in MAP_INTS:
+            setattr(self, name, 0)
+
+    @classmethod
+    def from_bytes(cls, data):
+        # data is the contents of a .map file, as any bytes-like object.
+        if len(data) < MAP_FILE_SIZE:
+            fail('Map data is %d bytes, expected %d.' % (len(data), MAP_FILE_SIZE))
+        rbmap = cls.__new__(cls)
+        buf = memoryview(data)
+        for name, offset, size in MAP_SECTIONS:
+            values = array('h')
+            values.frombytes(buf[offset:offset+size*2])
+            setattr(rbmap, name, values)
+        for name, offset in MAP_INTS:
+            setattr(rbmap, name, struct.unpack_from('i', buf, offset)[0])
+        buf.release()
+        return rbmap
+
+    @classmethod
+    def from_tiled_dict(cls, jsondata, base=None, tileset_dir=None):
+        # builds a map from a tiled map document, as written by to_tiled_dict or map_to_json.
+        # like json_to_map, anything the document does not set (area, version and any missing
+        # minimap layers) is taken from base. without a base, area and version are read from
+        # the document's properties. split tilesets are read from tileset_dir.
+        if base != None:
+            rbmap = base.copy()
+        else:
+            rbmap = cls()
+            properties = jsondata.get('properties', {})
+            rbmap.area = properties.get('area', 0)
+            rbmap.version = properties.get('version', 0)
+        for name, values in tiled_to_map_arrays(jsondata, tileset_dir=tileset_dir).items():
+            if isinstance(values, dict):
+                values = scatter_cells(values, MAP_SIZE)
+            if values != None:
+                setattr(rbmap, name, array('h', values))
+        return rbmap
+
+    def copy(self):
+        rbmap = self.__class__.__new__(self.__class__)
+        for name in self.__slots__:
+            value = getattr(self, name)
+            setattr(rbmap, name, value[:] if isinstance(value, array) else value)
+        return rbmap
+
+    def sections(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def to_bytes(self):
+        buf = bytearray(MAP_FILE_SIZE)
+        for name, offset, size in MAP_SECTIONS:
+            buf[offset:offset+size*2] = getattr(self, name).tobytes()
+        for name, offset in MAP_INTS:
+            struct.pack_into('i', buf, offset, getattr(self, name))
+        return bytes(buf)
+
+    def to_tiled_dict(self, layer_encoding='array', chunked=False, tilesets=DEFAULT_TILESETS):
+        # the same tiled map document map_to_json writes for this map.
+        data, layers = map_sections_to_tiled(self.sections(), layer_encoding, chunked, tilesets)
+        data['layers'] = list(layers)
+        return data
 
-    if bunmania_mode:
-        apply_metadata(map_arrays, metadata)
-
-    f = open(targetfile, "r+b")
-    f.seek(ARRAY_MAP)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['collision']))
-    f.seek(ARRAY_EVENT)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['event']))
-    f.seek(ARRAY_ITEMS)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['items']))
-    if map_arrays["roomtype"]:
-        f.seek(ARRAY_ROOMTYPE)
-        f.write(struct.pack('%dh' % MINIMAP_SIZE, *map_arrays["roomtype"]))
-    if map_arrays["roomcolor"]:
-        f.seek(ARRAY_ROOMCOLOR)
-        f.write(struct.pack('%dh' % MINIMAP_SIZE, *map_arrays["roomcolor"]))
-    if map_arrays["roombg"]:
-        f.seek(ARRAY_ROOMBG)
-        f.write(struct.pack('%dh' % MINIMAP_SIZE, *map_arrays["roombg"]))
-    f.seek(ARRAY_TILES_0)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['tiles0']))
-    f.seek(ARRAY_TILES_1)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['tiles1']))
-    f.seek(ARRAY_TILES_2)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['tiles2']))
-    f.seek(ARRAY_TILES_3)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['tiles3']))
-    f.seek(ARRAY_TILES_4)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['tiles4']))
-    f.seek(ARRAY_TILES_5)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['tiles5']))
-    f.seek(ARRAY_TILES_6)
-    f.write(struct.pack('%dh' % MAP_SIZE, *map_arrays['tiles6']))
+# patch file layout, little-endian:
+#   header: magic, format version, sha1 of the base map, size of the patched map
+#   body (zlib-compressed): records of (offset, length) followed by length bytes of new data
+PATCH_MAGIC = b'RBMPATCH'
+PATCH_VERSION = 1
+PATCH_HEADER = struct.Struct('<8sI20sI')
+PATCH_RECORD = struct.Struct('<II')
+# differences closer than this are merged into one record, as a record header costs 8 bytes.
+PATCH_MERGE_GAP = 16
+
+def find_changed_ranges(old, new):
+    # returns the sorted (start, end) byte ranges where new differs from old. equal spans are
+    # skipped by comparing ever smaller blocks, so an unchanged section costs one comparison.
+    old = memoryview(old).cast('B')
+    new = memoryview(new).cast('B')
+    ranges = []
+
+    def add_range(start, end):
+        if ranges and start - ranges[-1][1] < PATCH_MERGE_GAP:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+
+    def compare(start, end):
+        if old[start:end] == new[start:end]: return
+        if end - start <= 64:
+            while old[start] == new[start]: start += 1
+            while old[end-1] == new[end-1]: end -= 1
+            return add_range(start, end)
+        step = max(64, (end - start + 15) // 16)
+        for block_start in range(start, end, step):
+            compare(block_start, min(end, block_start + step))
+
+    common = min(len(old), len(new))
+    for start in range(0, common, 1<<16):
+        compare(start, min(common, start + (1<<16)))
+    if len(new) > common:
+        add_range(common, len(new))
+    return ranges
+
+def make_map_patch(base, target):
+    body = bytearray()
+    for start, end in find_changed_ranges(base, target):
+        body += PATCH_RECORD.pack(start, end - start)
+        body += target[start:end]
+    header = PATCH_HEADER.pack(PATCH_MAGIC, PATCH_VERSION, hashlib.sha1(base).digest(), len(target))
+    return header + zlib.compress(bytes(body), 9)
+
+def apply_map_patch(base, patch):
+    if len(patch) < PATCH_HEADER.size: fail('Patch file is truncated.')
+    magic, version, base_hash, size = PATCH_HEADER.unpack_from(patch)
+    if magic != PATCH_MAGIC: fail('Not a map patch file.')
+    if version != PATCH_VERSION: fail('Unsupported map patch version %d.' % version)
+    if hashlib.sha1(base).digest() != base_hash:
+        fail('The patch was made against a different version of the original map.')
+
+    try:
+        body = zlib.decompress(patch[PATCH_HEADER.size:])
+    except zlib.error as e:
+        fail('Patch file is corrupt: %s' % e)
+    target = bytearray(base[:size])
+    target.extend(bytes(size - len(target)))
+    pos = 0
+    while pos < len(body):
+        offset, length = PATCH_RECORD.unpack_from(body, pos)
+        pos += PATCH_RECORD.size
+        if offset + length > size or pos + length > len(body): fail('Patch file is corrupt.')
+        target[offset:offset+length] = body[pos:pos+length]
+        pos += length
+    return bytes(target)
+
+def json_to_patch(filename, settings):
+    print('Converting Json -> Map patch : %s' % filename)
+    basemapfile = "%s/%s.map" % (settings.original_maps_dir, filename)
+    sourcefile = "%s/%s.json" % (settings.editable_maps_dir, filename)
+    targetfile = "%s/%s.mappatch" % (settings.patch_dir, filename)
+
+    f = open(basemapfile, 'rb')
+    base = f.read()
+    f.close()
+    # built the same way as json_to_map, so the bytes after the sections are kept.
+    map_arrays = tiled_to_map_arrays(read_tiled_json(sourcefile), tileset_dir=settings.editable_maps_dir)
+    buf = bytearray(base)
+    pack_map_arrays(buf, base, map_arrays)
+
+    f = open(targetfile, 'wb')
+    f.write(make_map_patch(base, buf))
+    f.close()
+
+def patch_to_map(filename, settings):
+    print('Applying map patch -> Final map file : %s' % filename)
+    basemapfile = "%s/%s.map" % (settings.original_maps_dir, filename)
+    sourcefile = "%s/%s.mappatch" % (settings.patch_dir, filename)
+    targetfile = "%s/%s.map" % (settings.final_maps_dir, filename)
+
+    f = open(basemapfile, 'rb')
+    base = f.read()
+    f.close()
+    f = open(sourcefile, 'rb')
+    patch = f.read()
+    f.close()
+    write_map_file(targetfile, apply_map_patch(base, patch))
+
+# pack archive layout: PREFIX.rbpack holds zlib-compressed blobs, one per distinct map region,
+# appended as maps are added. PREFIX.index.json lists the blobs by sha1, with their offset and
+# length in the archive, and every map as its size, sha1 and the sha1 of each of its regions.
+PACK_FORMAT = 1
+
+def pack_paths(prefix):
+    return '%s.rbpack' % prefix, '%s.index.json' % prefix
+
+def pack_regions():
+    # (name, start, end) of the regions maps are split into: every section and int, and the
+    # unused bytes between them. bytes past MAP_FILE_SIZE are stored as a last 'trailer' region.
+    fields = sorted([(offset, offset+size*2, name) for name, offset, size in MAP_SECTIONS] +
+        [(offset, offset+4, name) for name, offset in MAP_INTS])
+    regions = []
+    position = 0
+    for start, end, name in fields:
+        if start > position: regions.append(('unused%d' % position, position, start))
+        regions.append((name, start, end))
+        position = end
+    return regions
+
+def read_pack_index(prefix):
+    archive, index_path = pack_paths(prefix)
+    if not os.path.isfile(index_path):
+        return {'format': PACK_FORMAT, 'regions': pack_regions(), 'blobs': {}, 'maps': {}}
+    f = open(index_path)
+    index = json.loads(f.read())
+    f.close()
+    if index.get('format') != PACK_FORMAT:
+        fail('%s was made by a different version of the converter.' % index_path)
+    return index
+
+def write_pack_index(prefix, index):
+    archive, index_path = pack_paths(prefix)
+    f = open(index_path + '.tmp', 'w')
+    f.write(json.dumps(index, indent=1, sort_keys=True))
+    f.close()
+    os.replace(index_path + '.tmp', index_path)
+
+def pack_map(archive_file, index, filename, data):
+    # adds the regions of a map that the archive does not have yet. returns the number of new blobs.
+    if len(data) < MAP_FILE_SIZE:
+        fail('%s.map is too small to be a map file.' % filename)
+    blobs = index['blobs']
+    region_hashes = []
+    new_blobs = 0
+    regions = [(start, end) for name, start, end in index['regions']] + [(MAP_FILE_SIZE, len(data))]
+    for start, end in regions:
+        raw = data[start:end]
+        digest = hashlib.sha1(raw).hexdigest()
+        if digest not in blobs:
+            compressed = zlib.compress(raw)
+            archive_file.seek(0, os.SEEK_END)
+            blobs[digest] = [archive_file.tell(), len(compressed)]
+            archive_file.write(compressed)
+            new_blobs += 1
+        region_hashes.append(digest)
+    index['maps'][filename] = {'size': len(data), 'sha1': hashlib.sha1(data).hexdigest(), 'regions': region_hashes}
+    return new_blobs
+
+def read_packed_map(prefix, index, filename):
+    # rebuilds one map from the archive, reading only its own blobs.
+    archive, index_path = pack_paths(prefix)
+    if filename not in index['maps']:
+        fail('The map %s is not in %s.' % (filename, index_path))
+    entry = index['maps'][filename]
+    buf = bytearray()
+    f = open(archive, 'rb')
+    for digest in entry['regions']:
+        offset, length = index['blobs'][digest]
+        f.seek(offset)
+        buf += zlib.decompress(f.read(length))
+    f.close()
+    if len(buf) != entry['size'] or hashlib.sha1(buf).hexdigest() != entry['sha1']:
+        fail('The map %s in %s is corrupt.' % (filename, archive))
+    return bytes(buf)
+
+def pack_maps(filenames, settings):
+    archive, index_path = pack_paths(settings.pack_prefix)
+    index = read_pack_index(settings.pack_prefix)
+    # blobs are appended, and only referenced once the index is replaced. an interrupted run
+    # leaves unreferenced bytes at the end of the archive, but never a broken pack.
+    f = open(archive, 'ab' if os.path.isfile(archive) else 'wb')
+    total_size = 0
+    new_blobs = 0
+    try:
+        for filename in filenames:
+            print('Packing map : %s' % filename)
+            mapfile = open('%s/%s.map' % (settings.original_maps_dir, filename), 'rb')
+            data = mapfile.read()
+            mapfile.close()
+            total_size += len(data)
+            new_blobs += pack_map(f, index, filename, data)
+        f.flush()
+    finally:
+        f.close()
+    write_pack_index(settings.pack_prefix, index)
+    print('Packed %d maps (%d bytes) into %s, adding %d new sections. The archive holds %d maps in %d bytes.'
+        % (len(filenames), total_size, archive, new_blobs, len(index['maps']), os.path.getsize(archive)))
+
+def unpack_maps(filenames, settings):
+    index = read_pack_index(settings.pack_prefix)
+    has_override = False
+    maps = []
+    for filename in filenames:
+        data = read_packed_map(settings.pack_prefix, index, filename)
+        targetfile = '%s/%s.map' % (settings.original_maps_dir, filename)
+        if os.path.isfile(targetfile):
+            if file_hash(targetfile) == index['maps'][filename]['sha1']: continue
+            print('The file %s already exists.' % targetfile)
+            has_override = True
+        maps.append((filename, data))
+    if has_override:
+        fail('There are original .map files that would be overwritten by different maps from the pack! '
+            'Please move them away before running this again.')
+    for filename, data in maps:
+        print('Unpacking map : %s' % filename)
+        write_map_file('%s/%s.map' % (settings.original_maps_dir, filename), data)
+    print('Unpacked %d maps. %d were already up to date.' % (len(maps), len(filenames) - len(maps)))
+
+# mismatched cells listed per section by --verify. the rest are only counted.
+VERIFY_SAMPLES = 10
+
+def mismatched_values(old, new):
+    # yields (name, index, old value, new value) for every section value or int that differs
+    # between two maps. only the byte ranges find_changed_ranges reports are unpacked.
+    for start, end in find_changed_ranges(old, new):
+        for name, offset, size in MAP_SECTIONS:
+            if start >= offset + size*2 or end <= offset: continue
+            first = (max(start, offset) - offset)//2
+            last = (min(end, offset + size*2) - offset + 1)//2
+            for index in range(first, last):
+                a, = struct.unpack_from('h', old, offset + index*2)
+                b, = struct.unpack_from('h', new, offset + index*2)
+                if a != b: yield name, index, a, b
+        for name, offset in MAP_INTS:
+            if start >= offset + 4 or end <= offset: continue
+            a, = struct.unpack_from('i', old, offset)
+            b, = struct.unpack_from('i', new, offset)
+            if a != b: yield name, None, a, b
+
+def section_cell(name, index):
+    # the x, y coordinates of a value of a section. minimap sections have one value per room.
+    if index == None: return None, None
+    if name in ('roomtype', 'roomcolor', 'roombg'): return index//18, index%18
+    return index//200, index%200
+
+def describe_cell(name, index):
+    if index == None: return name
+    x, y = section_cell(name, index)
+    return '%s %s %d, %d' % (name, 'room' if name in ('roomtype', 'roomcolor', 'roombg') else 'cell', x, y)
+
+def describe_mismatch(name, index, old_value, new_value, bunmania_mode):
+    if index == None:
+        return '%s %d became %d' % (name, old_value, new_value)
+    hint = ''
+    if name == 'event' and bunmania_mode and index%200 < 10:
+        hint = ' (bunmania metadata)'
+    elif new_value == -old_value:
+        hint = ' (flip lost)'
+    elif abs(new_value - old_value) == 5000:
+        hint = ' (5000 offset lost)'
+    return '%s: %d became %d%s' % (describe_cell(name, index), old_value, new_value, hint)
+
+def verify_map(filename, settings):
+    # converts a map to json and back in memory, and warns about every value that changes.
+    print('Verifying round trip : %s' % filename)
+    f = open('%s/%s.map' % (settings.original_maps_dir, filename), 'rb')
+    original = f.read()
     f.close()
 
+    with profile_stage('read map'):
+        rbmap = RabiRibiMap.from_bytes(original)
+        bunmania_mode = extract_encoded_metadata(nonzero_cells(rbmap.event))[0]['bm_name'] != ''
+    with profile_stage('write json'):
+        out = io.StringIO()
+        data, layers = map_sections_to_tiled(rbmap.sections(), settings.layer_encoding, settings.chunked, map_tilesets(settings))
+        write_json_stream(out, data, 'layers', layers)
+    with profile_stage('parse json'):
+        jsondata = parse_tiled_json(out.getvalue())
+    with profile_stage('decode layers'):
+        roundtrip = RabiRibiMap.from_tiled_dict(jsondata, tileset_dir=settings.editable_maps_dir)
+    with profile_stage('compare'):
+        # bytes past the sections are copied from the original map by json_to_map.
+        mismatches = {}
+        for name, index, old_value, new_value in mismatched_values(original[:MAP_FILE_SIZE], roundtrip.to_bytes()):
+            mismatches.setdefault(name, []).append(describe_mismatch(name, index, old_value, new_value, bunmania_mode))
+
+    for name, descriptions in mismatches.items():
+        warn('%d values of %s in %s.map changed in the round trip.' % (len(descriptions), name, filename), 'round-trip-mismatch', name)
+        for description in descriptions[:VERIFY_SAMPLES]:
+            print('    %s' % description)
+        if len(descriptions) > VERIFY_SAMPLES:
+            print('    ... and %d more' % (len(descriptions) - VERIFY_SAMPLES))
+
+# (format, byte offset) of the first value of every section and int of a map.
+MAP_FIELDS = dict([(name, ('h', offset)) for name, offset, size in MAP_SECTIONS] + [(name, ('i', offset)) for name, offset in MAP_INTS])
+
+def rebase_map(filename, settings):
+    # merges the edits in an editable json file onto the updated original map in the rebase dir.
+    # the edited map is compared with the original map it was made from, and every value the
+    # edit changed is copied onto the updated map. values the update changed too, to something
+    # else, are conflicts. they keep the edited value and are listed in NAME.conflicts.json.
+    print('Rebasing Json onto updated map : %s' % filename)
+    sourcefile = '%s/%s.json' % (settings.editable_maps_dir, filename)
+    targetfile = '%s/%s.json' % (settings.rebased_maps_dir, filename)
+    conflictfile = '%s/%s.conflicts.json' % (settings.rebased_maps_dir, filename)
+
+    with profile_stage('read maps'):
+        f = open('%s/%s.map' % (settings.original_maps_dir, filename), 'rb')
+        base = f.read()
+        f.close()
+        f = open('%s/%s.map' % (settings.rebase, filename), 'rb')
+        updated = f.read()
+        f.close()
+        if len(updated) < MAP_FILE_SIZE:
+            fail('%s/%s.map is too small to be a map file.' % (settings.rebase, filename))
+    with profile_stage('parse json'):
+        jsondata = read_tiled_json(sourcefile)
+    with profile_stage('decode layers'):
+        edited = RabiRibiMap.from_tiled_dict(jsondata, base=RabiRibiMap.from_bytes(base), tileset_dir=settings.editable_maps_dir)
+        # json_to_map takes area and version from the original map, but they can be edited in tiled too.
+        properties = jsondata.get('properties', {})
+        edited.area = int(properties.get('area', edited.area))
+        edited.version = int(properties.get('version', edited.version))
+
+    with profile_stage('merge'):
+        merged = bytearray(updated)
+        conflicts = []
+        for name, index, base_value, edited_value in mismatched_values(base[:MAP_FILE_SIZE], edited.to_bytes()):
+            fmt, offset = MAP_FIELDS[name]
+            if index != None: offset += index*2
+            updated_value, = struct.unpack_from(fmt, updated, offset)
+            if updated_value != base_value and updated_value != edited_value:
+                x, y = section_cell(name, index)
+                conflicts.append({'section': name, 'x': x, 'y': y, 'original': base_value, 'edited': edited_value, 'updated': updated_value})
+                warn('%s : edited %d -> %d, updated to %d. Keeping the edit.' % (describe_cell(name, index), base_value, edited_value, updated_value), 'rebase-conflict', name, x, y)
+            struct.pack_into(fmt, merged, offset, edited_value)
+
+    with profile_stage('write json'):
+        data, layers = map_sections_to_tiled(RabiRibiMap.from_bytes(merged).sections(), settings.layer_encoding, settings.chunked, map_tilesets(settings))
+        f = open(targetfile + '.tmp', 'w')
+        try:
+            write_json_stream(f, data, 'layers', layers)
+        except BaseException:
+            f.close()
+            os.remove(targetfile + '.tmp')
+            raise
+        f.close()
+        os.replace(targetfile + '.tmp', targetfile)
+
+    if conflicts:
+        f = open(conflictfile, 'w')
+        f.write(json.dumps(conflicts, indent=1))
+        f.close()
+    elif os.path.isfile(conflictfile):
+        os.remove(conflictfile)
+
+def rebase_maps(filenames, settings):
+    if os.path.abspath(settings.rebased_maps_dir) == os.path.abspath(settings.editable_maps_dir):
+        fail('The rebased maps dir must not be the editable maps dir, as the edited json files would be overwritten.')
+    missing = [filename for filename in filenames if not os.path.isfile('%s/%s.map' % (settings.rebase, filename))]
+    if missing:
+        fail('There are no updated maps in %s for %s.' % (settings.rebase, ', '.join(missing)))
+    if not os.path.isdir(settings.rebased_maps_dir): os.makedirs(settings.rebased_maps_dir)
+
+    has_override = False
+    for filename in filenames:
+        if os.path.isfile('%s/%s.json' % (settings.rebased_maps_dir, filename)):
+            print('The file %s/%s.json already exists.' % (settings.rebased_maps_dir, filename))
+            has_override = True
+    if has_override:
+        fail('There are rebased .json files that would be overwritten! '
+            'Please delete them manually before running this again.')
+
+    conflicted = []
+    def on_converted(filename, has_warnings):
+        if os.path.isfile('%s/%s.conflicts.json' % (settings.rebased_maps_dir, filename)): conflicted.append(filename)
+    convert_all(rebase_map, filenames, settings, on_converted)
+    if conflicted:
+        print('%d of %d maps have conflicts, listed in %s: %s' % (len(conflicted), len(filenames), settings.rebased_maps_dir, ', '.join(conflicted)))
+    else:
+        print('All %d maps rebased without conflicts.' % len(filenames))
+
+# sections of the query index. tiles matches all tile layers.
+QUERY_SECTIONS = ('event', 'items', 'tiles0', 'tiles1', 'tiles2', 'tiles3', 'tiles4', 'tiles5', 'tiles6', 'roomtype', 'roomcolor', 'roombg')
+TILE_SECTIONS = ('tiles0', 'tiles1', 'tiles2', 'tiles3', 'tiles4', 'tiles5', 'tiles6')
+# postings file layout, native byte order:
+#   header: magic, section count, then for each section its name, value count, cell count and offset
+#   each section: its distinct nonzero values as shorts, sorted, then the uint32 start of each value's
+#   cells, then the uint32 cell indices of every value in turn, sorted within each value
+POSTINGS_MAGIC = b'RBMQIDX1'
+POSTINGS_HEADER = struct.Struct('8sI')
+POSTINGS_SECTION = struct.Struct('12sIIQ')
+QUERY_INDEX_FORMAT = 1
+
+def build_postings(sections):
+    # groups the nonzero cells of each query section by value.
+    blocks = []
+    for name in QUERY_SECTIONS:
+        data = sections[name]
+        cells = sorted(compress(range(len(data)), data), key=data.__getitem__)
+        values = array('h')
+        starts = array(UINT32)
+        for i, index in enumerate(cells):
+            if not values or data[index] != values[-1]:
+                values.append(data[index])
+                starts.append(i)
+        blocks.append((name, values, starts, array(UINT32, cells)))
+
+    out = io.BytesIO()
+    out.write(POSTINGS_HEADER.pack(POSTINGS_MAGIC, len(blocks)))
+    offset = POSTINGS_HEADER.size + POSTINGS_SECTION.size * len(blocks)
+    for name, values, starts, cells in blocks:
+        out.write(POSTINGS_SECTION.pack(name.encode('ascii'), len(values), len(cells), offset))
+        offset += len(values)*values.itemsize + len(starts)*starts.itemsize + len(cells)*cells.itemsize
+    for name, values, starts, cells in blocks:
+        out.write(values.tobytes())
+        out.write(starts.tobytes())
+        out.write(cells.tobytes())
+    return out.getvalue()
+
+def postings_path(filename, settings):
+    return '%s/%s.postings' % (settings.index_dir, filename)
+
+def index_map(filename, settings):
+    print('Indexing map : %s' % filename)
+    with open_map_sections('%s/%s.map' % (settings.original_maps_dir, filename)) as sections:
+        postings = build_postings(sections)
+    path = postings_path(filename, settings)
+    f = open(path + '.tmp', 'wb')
+    f.write(postings)
+    f.close()
+    os.replace(path + '.tmp', path)
+
+def update_query_index(settings):
+    # reindexes the maps that were added or changed since the last query, and forgets removed maps.
+    # index.json records the modification time and size each postings file was built from.
+    if not os.path.isdir(settings.index_dir): os.makedirs(settings.index_dir)
+    index_file = '%s/index.json' % settings.index_dir
+    index = {'format': QUERY_INDEX_FORMAT, 'maps_dir': os.path.abspath(settings.original_maps_dir), 'maps': {}}
+    if os.path.isfile(index_file):
+        f = open(index_file)
+        stored = json.loads(f.read())
+        f.close()
+        if stored.get('format') == QUERY_INDEX_FORMAT and stored.get('maps_dir') == index['maps_dir']:
+            index = stored
+
+    signatures = {}
+    for entry in os.scandir(settings.original_maps_dir):
+        if entry.is_file() and is_extension('map')(entry.name):
+            stat = entry.stat()
+            signatures[trim_extension(entry.name)] = [stat.st_mtime_ns, stat.st_size]
+    changed = sorted(name for name, signature in signatures.items() if index['maps'].get(name) != signature)
+    removed = [name for name in index['maps'] if name not in signatures]
+    if not changed and not removed: return index
+
+    for name in removed:
+        del index['maps'][name]
+        if os.path.isfile(postings_path(name, settings)): os.remove(postings_path(name, settings))
+
+    def on_indexed(filename, has_warnings):
+        index['maps'][filename] = signatures[filename]
+    try:
+        convert_all(index_map, changed, settings, on_indexed)
+    finally:
+        f = open(index_file + '.tmp', 'w')
+        f.write(json.dumps(index, indent=1, sort_keys=True))
+        f.close()
+        os.replace(index_file + '.tmp', index_file)
+    return index
+
+def read_postings_sections(f):
+    # returns {name: (value count, cell count, offset)} from the header of a postings file.
+    magic, count = POSTINGS_HEADER.unpack(f.read(POSTINGS_HEADER.size))
+    if magic != POSTINGS_MAGIC: fail('%s is not a postings file.' % f.name)
+    sections = {}
+    for i in range(count):
+        name, value_count, cell_count, offset = POSTINGS_SECTION.unpack(f.read(POSTINGS_SECTION.size))
+        sections[name.rstrip(b'\0').decode('ascii')] = (value_count, cell_count, offset)
+    return sections
+
+def read_postings_values(f, value_count, offset):
+    # returns the sorted distinct values of a section, and the start of each value's cells.
+    f.seek(offset)
+    values = array('h')
+    values.frombytes(f.read(value_count*values.itemsize))
+    starts = array(UINT32)
+    starts.frombytes(f.read(value_count*starts.itemsize))
+    return values, starts
+
+def value_ranges(section, lo, hi):
+    # tiles are negative when flipped horizontally, and 5000 higher when flipped vertically.
+    # a query for tile ids matches them however they are flipped.
+    if section not in TILE_SECTIONS or lo < 0:
+        return [(lo, hi)]
+    ranges = [(lo, hi)]
+    if hi < 5000: ranges.append((lo + 5000, hi + 5000))
+    return sorted(ranges + [(-range_hi, -range_lo) for range_lo, range_hi in ranges])
+
+def query_postings(path, sections, lo, hi, region):
+    # yields (section, index, value) for every cell of the sections with a value in lo..hi,
+    # and inside region (x0, y0, x1, y1, inclusive) if it is given.
+    f = open(path, 'rb')
+    stored = read_postings_sections(f)
+    for section in sections:
+        value_count, cell_count, offset = stored[section]
+        values, starts = read_postings_values(f, value_count, offset)
+        cells_offset = offset + value_count*(values.itemsize + starts.itemsize)
+        height = 18 if section in ('roomtype', 'roomcolor', 'roombg') else 200
+        for range_lo, range_hi in value_ranges(section, lo, hi):
+            first, last = bisect_left(values, range_lo), bisect_right(values, range_hi)
+            if first >= last: continue
+            end = starts[last] if last < value_count else cell_count
+            f.seek(cells_offset + starts[first]*starts.itemsize)
+            cells = array(UINT32)
+            cells.frombytes(f.read((end - starts[first])*cells.itemsize))
+            position = starts[first]
+            for i in range(first, last):
+                value_end = starts[i+1] if i+1 < value_count else cell_count
+                for index in cells[position - starts[first]:value_end - starts[first]]:
+                    x, y = index//height, index%height
+                    if region == None or (region[0] <= x <= region[2] and region[1] <= y <= region[3]):
+                        yield section, x, y, values[i]
+                position = value_end
+    f.close()
+
+def postings_histogram(path, sections):
+    # returns {value: cell count} over the sections, read from the postings headers alone.
+    histogram = {}
+    f = open(path, 'rb')
+    stored = read_postings_sections(f)
+    for section in sections:
+        value_count, cell_count, offset = stored[section]
+        values, starts = read_postings_values(f, value_count, offset)
+        for i, value in enumerate(values):
+            end = starts[i+1] if i+1 < value_count else cell_count
+            histogram[value] = histogram.get(value, 0) + end - starts[i]
+    f.close()
+    return histogram
+
+def parse_query(query):
+    # SECTION, SECTION=VALUE or SECTION=LO..HI. returns (sections, lo, hi).
+    section, _, values = query.partition('=')
+    if section == 'tiles':
+        sections = TILE_SECTIONS
+    elif section in QUERY_SECTIONS:
+        sections = (section,)
+    else:
+        fail('Cannot query "%s". Use one of %s or tiles.' % (section, ', '.join(QUERY_SECTIONS)))
+    try:
+        if values == '':
+            lo, hi = -32768, 32767
+        elif '..' in values:
+            lo, hi = (int(v) for v in values.split('..', 1))
+        else:
+            lo = hi = int(values)
+    except ValueError:
+        fail('Invalid query values "%s". Use a number, or a range like 500..599.' % values)
+    return sections, lo, hi
+
+def run_query(settings):
+    sections, lo, hi = parse_query(settings.query)
+    region = None
+    if settings.region != None:
+        try:
+            region = [int(v) for v in settings.region.split(',')]
+        except ValueError:
+            region = []
+        if len(region) != 4: fail('Invalid region "%s". Use X0,Y0,X1,Y1.' % settings.region)
+
+    index = update_query_index(settings)
+    start_time = time.perf_counter()
+    filenames = select_maps(sorted(index['maps']), settings)
+
+    if settings.histogram:
+        # flips do not change which tile is used, so tiles are counted by tile id.
+        total = {}
+        for filename in filenames:
+            for value, count in postings_histogram(postings_path(filename, settings), sections).items():
+                if sections[0] in TILE_SECTIONS: value = abs(value) % 5000
+                if lo <= value <= hi: total[value] = total.get(value, 0) + count
+        for value, count in sorted(total.items(), key=lambda item: (-item[1], item[0])):
+            print('%6d  %d' % (value, count))
+        print('%d distinct values in %d maps (%.1f ms).' % (len(total), len(filenames), (time.perf_counter() - start_time)*1000))
+        return
+
+    matches = 0
+    matched_maps = 0
+    for filename in filenames:
+        found = False
+        for section, x, y, value in query_postings(postings_path(filename, settings), sections, lo, hi, region):
+            print('%s %s %d,%d = %d' % (filename, section, x, y, value))
+            matches += 1
+            found = True
+        if found: matched_maps += 1
+    print('%d matches in %d of %d maps (%.1f ms).' % (matches, matched_maps, len(filenames), (time.perf_counter() - start_time)*1000))
+
+# draw order of the tile layers, the same as in map_to_json.
+RENDER_ORDER = ('tiles0', 'tiles3', 'tiles4', 'tiles1', 'tiles5', 'tiles6', 'tiles2')
+RENDER_OVERLAYS = ('collision', 'event', 'items')
+# overlay colors, the same as the object layer colors in tiled.
+RENDER_OBJECT_COLORS = {'event': b'\x80\x80\xff', 'items': b'\xff\x60\x00'}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+ATLAS_FORMAT = 1
+
+def add_bytes(a, b):
+    # bytewise (a + b) & 0xff of two equally long byte strings, with big integers instead of a loop.
+    # the low 7 bits of each byte are added without carrying into the next byte, then the top bit is fixed up.
+    n = len(a)
+    low = int.from_bytes(b'\x7f'*n, 'big')
+    x = int.from_bytes(a, 'big')
+    y = int.from_bytes(b, 'big')
+    return (((x & low) + (y & low)) ^ ((x ^ y) & ~low)).to_bytes(n, 'big')
+
+def unfilter_png_rows(raw, width, height, bpp):
+    stride = width*bpp
+    out = bytearray(stride*height)
+    prev = bytes(stride)
+    for y in range(height):
+        start = y*(stride+1)
+        kind = raw[start]
+        line = raw[start+1:start+1+stride]
+        if kind == 0:
+            row = line
+        elif kind == 1:
+            # running sums of each channel, in c.
+            row = bytearray(stride)
+            for c in range(bpp):
+                row[c::bpp] = bytes(map((255).__and__, accumulate(line[c::bpp])))
+        elif kind == 2:
+            row = add_bytes(line, prev)
+        elif kind == 3:
+            row = bytearray(line)
+            for i in range(stride):
+                left = row[i-bpp] if i >= bpp else 0
+                row[i] = (row[i] + ((left + prev[i]) >> 1)) & 255
+        elif kind == 4:
+            row = bytearray(line)
+            for i in range(stride):
+                if i >= bpp:
+                    a, c = row[i-bpp], prev[i-bpp]
+                else:
+                    a, c = 0, 0
+                b = prev[i]
+                p = a + b - c
+                pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+                row[i] = (row[i] + (a if pa <= pb and pa <= pc else b if pb <= pc else c)) & 255
+        else:
+            fail('Unknown png filter %d.' % kind)
+        out[y*stride:(y+1)*stride] = row
+        prev = row
+    return out
+
+def read_png(path):
+    # decodes an 8-bit, non-interlaced png. returns its width, height and rgba pixels.
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    if data[:8] != PNG_SIGNATURE: fail('%s is not a png file.' % path)
+    pos = 8
+    header = None
+    palette = b''
+    transparency = b''
+    idat = []
+    while pos + 8 <= len(data):
+        length, kind = struct.unpack_from('>I4s', data, pos)
+        chunk = data[pos+8:pos+8+length]
+        pos += length + 12
+        if kind == b'IHDR': header = struct.unpack('>IIBBBBB', chunk)
+        elif kind == b'PLTE': palette = chunk
+        elif kind == b'tRNS': transparency = chunk
+        elif kind == b'IDAT': idat.append(chunk)
+        elif kind == b'IEND': break
+    if header == None: fail('%s is not a png file.' % path)
+    width, height, depth, color_type, compression, filter_method, interlace = header
+    if depth != 8 or interlace != 0 or color_type not in PNG_CHANNELS:
+        fail('%s must be an 8-bit png without interlacing. Please resave it.' % path)
+    bpp = PNG_CHANNELS[color_type]
+    pixels = unfilter_png_rows(zlib.decompress(b''.join(idat)), width, height, bpp)
+
+    if color_type == 6: return width, height, pixels
+    rgba = bytearray(b'\xff'*(width*height*4))
+    if color_type == 3:
+        # palette lookups with bytes.translate, one channel at a time.
+        palette = palette.ljust(768, b'\x00')
+        alpha = transparency.ljust(256, b'\xff')[:256]
+        for c in range(3):
+            rgba[c::4] = pixels.translate(palette[c::3])
+        rgba[3::4] = pixels.translate(alpha)
+    elif color_type == 2:
+        for c in range(3):
+            rgba[c::4] = pixels[c::3]
+    else:
+        for c in range(3):
+            rgba[c::4] = pixels[0::bpp]
+        if color_type == 4: rgba[3::4] = pixels[1::2]
+    return width, height, rgba
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+def write_png(path, width, height, rows):
+    # writes rows of 8-bit rgb pixels as an unfiltered png.
+    compressor = zlib.compressobj()
+    idat = [compressor.compress(b'\x00' + row) for row in rows]
+    idat.append(compressor.flush())
+    f = open(path + '.tmp', 'wb')
+    f.write(PNG_SIGNATURE)
+    f.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+    f.write(png_chunk(b'IDAT', b''.join(idat)))
+    f.write(png_chunk(b'IEND', b''))
+    f.close()
+    os.replace(path + '.tmp', path)
+
+def load_atlas(tileset, render_dir):
+    # returns the width, height and rgba pixels of a tileset image. decoding a large png in
+    # python is slow, so the pixels are cached in the render dir until the image changes.
+    image = tileset['image']
+    if image == None: fail('A tileset to render has no image.')
+    if not os.path.isfile(image): fail('The tileset image %s was not found.' % image)
+    stat = os.stat(image)
+    source = {'format': ATLAS_FORMAT, 'image': os.path.abspath(image), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    cache = '%s/atlas/%s' % (render_dir, os.path.basename(image))
+    if os.path.isfile(cache + '.json') and os.path.isfile(cache + '.rgba'):
+        f = open(cache + '.json')
+        meta = json.loads(f.read())
+        f.close()
+        if meta['source'] == source:
+            f = open(cache + '.rgba', 'rb')
+            pixels = f.read()
+            f.close()
+            if len(pixels) == meta['width']*meta['height']*4:
+                return meta['width'], meta['height'], pixels
+
+    with profile_stage('decode tileset'):
+        width, height, pixels = read_png(image)
+    if not os.path.isdir(os.path.dirname(cache)): os.makedirs(os.path.dirname(cache))
+    f = open(cache + '.rgba.tmp', 'wb')
+    f.write(pixels)
+    f.close()
+    os.replace(cache + '.rgba.tmp', cache + '.rgba')
+    f = open(cache + '.json', 'w')
+    f.write(json.dumps({'source': source, 'width': width, 'height': height}))
+    f.close()
+    return width, height, pixels
+
+@functools.lru_cache(maxsize=None)
+def tile_painter(tsx_path, tile_size, render_dir):
+    # returns a function giving the pixels of a tile, scaled to tile_size, and the mask of its
+    # opaque pixels, as big integers. pixels are the rgb bytes of each row in turn, with
+    # transparent pixels left black. masks are 0xff for each byte of an opaque pixel, or None
+    # if the whole tile is opaque.
+    # tiles are sliced from the atlas the first time they are used, and then cached. tile 0 is
+    # the first tile of the tileset, so callers must leave empty cells out themselves.
+    tileset = read_tileset(tsx_path)
+    width, height, pixels = load_atlas(tileset, render_dir)
+    tw, th = tileset['tilewidth'], tileset['tileheight']
+    columns = tileset['columns'] or (width - tileset['margin'] + tileset['spacing']) // (tw + tileset['spacing'])
+    sample_x = [x*tw//tile_size for x in range(tile_size)]
+    sample_y = [y*th//tile_size for y in range(tile_size)]
+    opaque = bytes(0 if a < 128 else 255 for a in range(256))
+    opaque_tile = b'\xff'*(tile_size*tile_size*3)
+
+    @functools.lru_cache(maxsize=None)
+    def paint(index, flip_x, flip_y):
+        left = tileset['margin'] + (index % columns)*(tw + tileset['spacing'])
+        top = tileset['margin'] + (index // columns)*(th + tileset['spacing'])
+        if index < 0 or left + tw > width or top + th > height: return 0, 0
+        # flipped tiles are sampled from the far side, so downscaling does not shift them.
+        xs = [tw-1-x for x in sample_x] if flip_x else sample_x
+        ys = [th-1-y for y in sample_y] if flip_y else sample_y
+        starts = [((top + sy)*width + left)*4 for sy in ys]
+        if tw % tile_size == 0:
+            # every step-th pixel of the sampled tile rows, one channel at a time. flipped tiles
+            # are read backwards, so their rows are joined in reverse.
+            step = tw // tile_size * 4
+            lines = b''.join([pixels[start:start+tw*4] for start in (starts[::-1] if flip_x else starts)])
+            channels = [lines[len(lines)-4+c::-step] if flip_x else lines[c::step] for c in range(4)]
+        else:
+            lines = b''.join([pixels[start+sx*4:start+sx*4+4] for start in starts for sx in xs])
+            channels = [lines[c::4] for c in range(4)]
+        rows = bytearray(tile_size*tile_size*3)
+        masks = bytearray(tile_size*tile_size*3)
+        alpha = channels[3].translate(opaque)
+        for c in range(3):
+            rows[c::3] = channels[c]
+            masks[c::3] = alpha
+        if masks == opaque_tile: return int.from_bytes(rows, 'big'), None
+        masks = int.from_bytes(masks, 'big')
+        return int.from_bytes(rows, 'big') & masks, masks
+
+    return paint
+
+def render_sections(sections, tile_size, tiles, collision, overlays):
+    # composites the layers one cell at a time, laying each tile over the ones below with masks
+    # on integers. a cell only depends on the values of its layers, so each stack of values is
+    # composited once, and the rows of pixels are joined from the cached cells.
+    tile_bytes = tile_size*tile_size*3
+    row_bytes = tile_size*3
+    halves = int.from_bytes(b'\x7f'*tile_bytes, 'big')
+    opaque = int.from_bytes(b'\xff'*tile_bytes, 'big')
+    def paint_tile(value):
+        i = abs(value)
+        flip_y = i >= 5000
+        if flip_y: i -= 5000
+        return tiles(i - 2*(i//32), value < 0, flip_y)
+
+    # each layer keeps the tiles it painted, keyed by map value. 0 is an empty cell.
+    layers = [(name, paint_tile, {}, False) for name in RENDER_ORDER]
+    if 'collision' in overlays:
+        layers.append(('collision', lambda value: collision(value, False, False), {}, True))
+
+    tiles_of = [(cache, blend) for name, paint, cache, blend in layers]
+    split_rows = struct.Struct('%ds' % row_bytes * tile_size).unpack
+    def composite(stack):
+        d = 0
+        for value, (cache, blend) in zip(stack, tiles_of):
+            if not value: continue
+            s, m = cache[value]
+            if blend:
+                s = ((d >> 1) & halves) + ((s >> 1) & halves)
+                d ^= (d ^ s) & (opaque if m == None else m)
+            # tile pixels are black where they are transparent, so opaque tiles and the
+            # lowest tile drawn need no mask.
+            elif m == None or d == 0: d = s
+            else: d ^= (d ^ s) & m
+        return split_rows(d.to_bytes(tile_bytes, 'big'))
+
+    # the cells are kept for all rows, unless there are so many different ones that they
+    # would take more than about 32MB.
+    max_cells = (32 << 20) // (tile_bytes + 40*tile_size + 200)
+    cells = {}
+    image = []
+    for y in range(200):
+        columns = []
+        for name, paint, cache, blend in layers:
+            values = sections[name][y::200]
+            for value in set(values).difference(cache):
+                if value: cache[value] = paint(value)
+            columns.append(values)
+        stacks = list(zip(*columns))
+        new_stacks = set(stacks).difference(cells)
+        if len(cells) + len(new_stacks) > max_cells:
+            cells.clear()
+            new_stacks = set(stacks)
+        for stack in new_stacks:
+            cells[stack] = composite(stack)
+        image.extend(map(bytearray, map(b''.join, zip(*map(cells.__getitem__, stacks)))))
+
+    # objects are drawn as squares half a tile wide, in the middle of their cell.
+    inset = tile_size // 4
+    size = max(1, tile_size - 2*inset)
+    for name in ('event', 'items'):
+        if name not in overlays: continue
+        square = RENDER_OBJECT_COLORS[name]*size
+        for index in nonzero_cells(sections[name]):
+            x, y = index // 200, index % 200
+            start = (x*tile_size + inset)*3
+            for row in image[y*tile_size+inset:y*tile_size+inset+size]:
+                row[start:start+len(square)] = square
+    return image
+
+def render_map(filename, settings):
+    print('Rendering map : %s' % filename)
+    tile_size = settings.tile_size
+    tiles = tile_painter(os.path.abspath('%s/TILE_A.tsx' % settings.editable_maps_dir), tile_size, settings.render_dir)
+    collision = None
+    if 'collision' in settings.overlays:
+        collision = tile_painter(os.path.abspath('%s/collision.tsx' % settings.editable_maps_dir), tile_size, settings.render_dir)
+    with open_map_sections('%s/%s.map' % (settings.original_maps_dir, filename)) as sections:
+        with profile_stage('render'):
+            image = render_sections(sections, tile_size, tiles, collision, settings.overlays)
+    with profile_stage('write png'):
+        write_png('%s/%s.png' % (settings.render_dir, filename), 500*tile_size, 200*tile_size, image)
+
+def render_maps(filenames, settings):
+    unknown = [name for name in settings.overlays if name not in RENDER_OVERLAYS]
+    if unknown:
+        fail('Unknown overlays: %s. Choose from %s.' % (', '.join(unknown), ', '.join(RENDER_OVERLAYS)))
+    if not 1 <= settings.tile_size <= 32:
+        fail('The tile size must be from 1 to 32 pixels.')
+    if not os.path.isdir(settings.render_dir): os.makedirs(settings.render_dir)
+    # decode and cache the tilesets once, before the workers need them.
+    tilesets = ['TILE_A.tsx'] + (['collision.tsx'] if 'collision' in settings.overlays else [])
+    for name in tilesets:
+        load_atlas(read_tileset('%s/%s' % (settings.editable_maps_dir, name)), settings.render_dir)
+    convert_all(render_map, filenames, settings)
+
 def is_extension(ext):
     return lambda f : f.endswith('.%s' % ext)
 
 trim_extension = lambda f : f[:f.rfind('.')]
 
+def file_hash(path):
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    for chunk in iter(lambda: f.read(1<<20), b''):
+        h.update(chunk)
+    f.close()
+    return h.hexdigest()
+
+def manifest_path(settings):
+    # kept next to the final maps dir rather than inside it, as that may be the game's own data folder.
+    return '%s.manifest.json' % os.path.normpath(settings.final_maps_dir)
+
+def read_manifest(settings):
+    path = manifest_path(settings)
+    if not os.path.isfile(path): return {}
+    try:
+        f = open(path)
+        manifest = json.loads(f.read())
+        f.close()
+    except ValueError:
+        print('Build manifest %s is corrupt. Rebuilding all maps.' % path)
+        return {}
+    if manifest.get('converter') != CONVERTER_VERSION: return {}
+    return manifest.get('maps', {})
+
+def write_manifest(settings, manifest):
+    path = manifest_path(settings)
+    f = open(path + '.tmp', 'w')
+    f.write(json.dumps({'converter': CONVERTER_VERSION, 'maps': manifest}, indent=1, sort_keys=True))
+    f.close()
+    os.replace(path + '.tmp', path)
+
+def build_inputs(filename, settings, manifest):
+    # the .tsx files a map references are kept in its manifest entry, so the json is only
+    # scanned for them again when it has changed.
+    sourcefile = '%s/%s.json' % (settings.editable_maps_dir, filename)
+    json_hash = file_hash(sourcefile)
+    entry = manifest.get(filename)
+    if entry != None and entry['json'] == json_hash and entry.get('tilesets') != None:
+        sources = list(entry['tilesets'])
+    else:
+        sources = tileset_sources(sourcefile)
+    return {
+        'json': json_hash,
+        'base': file_hash('%s/%s.map' % (settings.original_maps_dir, filename)),
+        'tilesets': tileset_hashes(sources, settings.editable_maps_dir),
+    }
+
+def tileset_sources(sourcefile):
+    # the .tsx files a map references, as json_to_map reads them for split tilesets. a json
+    # that cannot be parsed has none, and fails when it is converted anyway.
+    try:
+        jsondata = read_tiled_json(sourcefile, layer_names=())
+    except ValueError:
+        return []
+    return [tileset['source'] for tileset in jsondata.get('tilesets', ()) if isinstance(tileset, dict) and 'source' in tileset]
+
+def tileset_hashes(sources, tileset_dir):
+    # missing files hash to None.
+    hashes = {}
+    for source in sources:
+        tsx_path = os.path.join(tileset_dir, source)
+        hashes[source] = file_hash(tsx_path) if os.path.isfile(tsx_path) else None
+    return hashes
+
+def is_up_to_date(filename, inputs, manifest, settings):
+    entry = manifest.get(filename)
+    if entry == None or entry.get('warnings'): return False
+    if entry['json'] != inputs['json'] or entry['base'] != inputs['base']: return False
+    if entry.get('tilesets') != inputs['tilesets']: return False
+    targetfile = '%s/%s.map' % (settings.final_maps_dir, filename)
+    return os.path.isfile(targetfile) and file_hash(targetfile) == entry['output']
+
+def record_build(filename, inputs, has_warnings, manifest, settings):
+    # maps with warnings are always rebuilt, so their warnings are not hidden by the cache.
+    # so are maps from --layers builds, whose other layers may not match the json. the output
+    # hash is kept either way, so json_to_map can tell the map is safe to update in place.
+    entry = dict(inputs)
+    entry['output'] = file_hash('%s/%s.map' % (settings.final_maps_dir, filename))
+    if has_warnings: entry['warnings'] = True
+    if settings.layers: entry['json'] = None
+    manifest[filename] = entry
+    write_manifest(settings, manifest)
+
+def run_conversion(task):
+    # runs one conversion in a worker process, capturing everything it prints.
+    global HAS_WARNINGS
+    convert, filename, settings = task
+    HAS_WARNINGS = False
+    failed = False
+    output = io.StringIO()
+    if settings.profile: start_profiling()
+    with contextlib.redirect_stdout(output):
+        try:
+            diagnosed_conversion(convert, filename, settings)
+        except ConversionError as e:
+            report_failure(e)
+            failed = True
+        except Exception:
+            traceback.print_exc(file=output)
+            failed = True
+    return output.getvalue(), HAS_WARNINGS, failed, PROFILE_EVENTS, DIAGNOSTIC_REPORTS.pop(filename)
+
+def convert_all(convert, filenames, settings, on_converted=None, keep_going=False):
+    # on_converted(filename, has_warnings) is called for every map that converts without failing.
+    # a failing map stops the conversion of the others, unless keep_going is set or they are
+    # converted in parallel.
+    global HAS_WARNINGS
+    jobs = settings.jobs if settings.jobs > 0 else os.cpu_count()
+    failed_filenames = []
+    if jobs <= 1 or len(filenames) <= 1:
+        for filename in filenames:
+            had_warnings, HAS_WARNINGS = HAS_WARNINGS, False
+            try:
+                diagnosed_conversion(convert, filename, settings)
+            except Exception as e:
+                HAS_WARNINGS = had_warnings or HAS_WARNINGS
+                if not keep_going: raise
+                if isinstance(e, ConversionError):
+                    report_failure(e)
+                else:
+                    traceback.print_exc(file=sys.stdout)
+                failed_filenames.append(filename)
+                continue
+            has_warnings = HAS_WARNINGS
+            HAS_WARNINGS = had_warnings or has_warnings
+            if on_converted: on_converted(filename, has_warnings)
+        if failed_filenames:
+            fail('%d of %d maps failed to convert: %s' % (len(failed_filenames), len(filenames), ', '.join(failed_filenames)))
+        return
+
+    # output is printed in filename order, regardless of which worker finishes first.
+    with multiprocessing.Pool(min(jobs, len(filenames))) as pool:
+        tasks = [(convert, filename, settings) for filename in filenames]
+        for filename, (output, has_warnings, failed, events, report) in zip(filenames, pool.imap(run_conversion, tasks)):
+            if events: PROFILE_EVENTS.extend(events)
+            DIAGNOSTIC_REPORTS[filename] = report
+            sys.stdout.write(output)
+            sys.stdout.flush()
+            if has_warnings: HAS_WARNINGS = True
+            if failed:
+                failed_filenames.append(filename)
+            elif on_converted:
+                on_converted(filename, has_warnings)
+
+    if failed_filenames:
+        fail('%d of %d maps failed to convert: %s' % (len(failed_filenames), len(filenames), ', '.join(failed_filenames)))
+
+WATCH_POLL_INTERVAL = 0.1
+# a file must stay unchanged this long before it is converted, so partial writes are not read.
+WATCH_DEBOUNCE = 0.2
+
+def editable_map_signatures(settings):
+    signatures = {}
+    for entry in os.scandir(settings.editable_maps_dir):
+        if entry.is_file() and is_extension('json')(entry.name):
+            stat = entry.stat()
+            signatures[trim_extension(entry.name)] = (stat.st_mtime_ns, stat.st_size)
+    return signatures
+
+def rebuild_final_map(filename, settings, manifest):
+    # every failure is reported, so that one bad rebuild does not stop the watch.
+    global HAS_WARNINGS
+    if not os.path.isfile('%s/%s.map' % (settings.original_maps_dir, filename)):
+        print('The map %s/%s.map is missing!' % (settings.original_maps_dir, filename))
+        return
+    start_time = time.time()
+    HAS_WARNINGS = False
+    try:
+        inputs = build_inputs(filename, settings, manifest)
+        if is_up_to_date(filename, inputs, manifest, settings): return
+        diagnosed_conversion(json_to_map, filename, settings)
+        record_build(filename, inputs, HAS_WARNINGS, manifest, settings)
+    except ConversionError as e:
+        report_failure(e)
+        return
+    except ValueError as e:
+        print('ERROR! Could not read %s/%s.json: %s' % (settings.editable_maps_dir, filename, e))
+        return
+    except OSError as e:
+        print('ERROR! Could not convert %s: %s' % (filename, e))
+        return
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        return
+    print('Updated %s/%s.map in %.2fs.' % (settings.final_maps_dir, filename, time.time() - start_time))
+
+def watch_editable_maps(settings, manifest):
+    # polls the editable maps dir, and reconverts each json file once it has stopped changing.
+    print('Watching %s for changes. Press Ctrl+C to stop.' % settings.editable_maps_dir)
+    known = editable_map_signatures(settings)
+    pending = {}
+    try:
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            now = time.time()
+            current = editable_map_signatures(settings)
+            for filename, signature in current.items():
+                if known.get(filename) == signature: continue
+                if filename not in pending or pending[filename][0] != signature:
+                    pending[filename] = (signature, now)
+
+            for filename, (signature, changed_time) in sorted(pending.items()):
+                if filename not in current:
+                    del pending[filename]
+                elif now - changed_time >= WATCH_DEBOUNCE:
+                    del pending[filename]
+                    known[filename] = signature
+                    rebuild_final_map(filename, settings, manifest)
+                    sys.stdout.flush()
+    except KeyboardInterrupt:
+        print('Stopped watching.')
+
+SERVE_PORT = 8765
+# request options that may override the server's own settings, as named on the command line.
+SERVE_OPTIONS = ('original-maps-dir', 'editable-maps-dir', 'final-maps-dir', 'patch-dir', 'layer-encoding', 'chunked', 'tilesets', 'layers', 'force')
+# options taking a list of names, given as a json list or, as on the command line, separated by commas.
+SERVE_LIST_OPTIONS = ('tilesets', 'layers')
+SERVE_FLAG_OPTIONS = ('chunked', 'force')
+
+def run_structured_conversion(task):
+    # runs one conversion, returning its warnings and error as data rather than printing them.
+    global HAS_WARNINGS
+    convert, filename, settings = task
+    HAS_WARNINGS = False
+    result = {'map': filename, 'ok': False, 'warnings': [], 'error': None}
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            diagnosed_conversion(convert, filename, settings)
+            result['ok'] = True
+        except ConversionError as e:
+            result['error'] = str(e)
+        except Exception as e:
+            result['error'] = '%s: %s' % (type(e).__name__, e)
+            result['traceback'] = traceback.format_exc()
+    report = DIAGNOSTIC_REPORTS.pop(filename)
+    for entry in report['codes'].values():
+        if entry['severity'] == 'warning':
+            result['warnings'].extend(sample['message'] for sample in entry['samples'])
+    result['diagnostics'] = report
+    result['output'] = output.getvalue()
+    return result
+
+def serve_directions():
+    # direction: (conversion, dir of its source files, source extension)
+    return {
+        'map-to-json': (map_to_json, 'original_maps_dir', 'map'),
+        'json-to-map': (json_to_map, 'editable_maps_dir', 'json'),
+        'json-to-patch': (json_to_patch, 'editable_maps_dir', 'json'),
+        'apply-patches': (patch_to_map, 'patch_dir', 'mappatch'),
+        'verify': (verify_map, 'original_maps_dir', 'map'),
+        'validate': (validate_json, 'editable_maps_dir', 'json'),
+    }
+
+def serve_request(request, settings, pool):
+    # handles one decoded request, {id, direction, maps, options}, and returns its response.
+    response = {'id': request.get('id'), 'results': [], 'error': None}
+    directions = serve_directions()
+    direction = request.get('direction')
+    if direction not in directions:
+        response['error'] = 'Unknown direction "%s". Use one of %s.' % (direction, ', '.join(sorted(directions)))
+        return response
+
+    request_settings = argparse.Namespace(**vars(settings))
+    request_settings.profile = None
+    for key, value in request.get('options', {}).items():
+        if key not in SERVE_OPTIONS:
+            response['error'] = 'Unknown option "%s". Use any of %s.' % (key, ', '.join(SERVE_OPTIONS))
+            return response
+        if key in SERVE_LIST_OPTIONS:
+            if isinstance(value, str): value = value.split(',')
+            valid = value == None or (isinstance(value, list) and all(isinstance(name, str) for name in value))
+            expected = 'a list of names or a comma-separated string'
+        elif key in SERVE_FLAG_OPTIONS:
+            valid, expected = isinstance(value, bool), 'true or false'
+        else:
+            valid, expected = isinstance(value, str), 'a string'
+        if not valid:
+            response['error'] = 'Option "%s" must be %s, not %s.' % (key, expected, json.dumps(value))
+            return response
+        setattr(request_settings, key.replace('-', '_'), value)
+    if request_settings.layer_encoding not in LAYER_ENCODINGS:
+        response['error'] = 'Unknown layer encoding "%s".' % request_settings.layer_encoding
+        return response
+
+    if request_settings.layers: check_layer_names(request_settings.layers)
+    convert, source_dir, source_extension = directions[direction]
+    source_dir = getattr(request_settings, source_dir)
+    filenames = request.get('maps')
+    if filenames == None:
+        filenames = list(map(trim_extension, filter(is_extension(source_extension), os.listdir(source_dir))))
+
+    # maps that cannot be converted are answered without running them.
+    early_results = {}
+    for filename in filenames:
+        if not os.path.isfile('%s/%s.%s' % (source_dir, filename, source_extension)):
+            early_results[filename] = 'The file %s/%s.%s is missing!' % (source_dir, filename, source_extension)
+        elif not os.path.isfile('%s/%s.map' % (request_settings.original_maps_dir, filename)):
+            early_results[filename] = 'The map %s/%s.map is missing!' % (request_settings.original_maps_dir, filename)
+        elif direction == 'map-to-json' and os.path.isfile('%s/%s.json' % (request_settings.editable_maps_dir, filename)):
+            early_results[filename] = 'The file %s/%s.json already exists.' % (request_settings.editable_maps_dir, filename)
+
+    skipped = set()
+    if direction == 'json-to-map':
+        manifest = read_manifest(request_settings)
+        inputs = dict((f, build_inputs(f, request_settings, manifest)) for f in filenames if f not in early_results)
+        if not request_settings.force:
+            skipped = set(f for f in inputs if is_up_to_date(f, inputs[f], manifest, request_settings))
+
+    tasks = [(convert, f, request_settings) for f in filenames if f not in early_results and f not in skipped]
+    results = dict((result['map'], result) for result in (pool.imap if pool else map)(run_structured_conversion, tasks))
+
+    for filename in filenames:
+        if filename in early_results:
+            result = {'map': filename, 'ok': False, 'warnings': [], 'error': early_results[filename], 'output': ''}
+        elif filename in skipped:
+            result = {'map': filename, 'ok': True, 'warnings': [], 'error': None, 'output': '', 'skipped': True}
+        else:
+            result = results[filename]
+            if direction == 'json-to-map' and result['ok']:
+                record_build(filename, inputs[filename], len(result['warnings']) > 0, manifest, request_settings)
+        response['results'].append(result)
+    return response
+
+def serve_conversions(settings):
+    # answers newline-delimited json requests on a localhost port, one json response line per request.
+    # conversions run one request at a time, each spread over the --jobs worker pool.
+    jobs = settings.jobs if settings.jobs > 0 else os.cpu_count()
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    lock = threading.Lock()
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip(): continue
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    if not isinstance(request, dict): raise ValueError('Requests must be json objects.')
+                except ValueError as e:
+                    response = {'id': None, 'results': [], 'error': 'Invalid request: %s' % e}
+                else:
+                    with lock:
+                        try:
+                            response = serve_request(request, settings, pool)
+                        except Exception as e:
+                            response = {'id': request.get('id'), 'results': [], 'error': '%s: %s' % (type(e).__name__, e)}
+                self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+                self.wfile.flush()
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', settings.port), RequestHandler)
+    server.daemon_threads = True
+    print('Serving conversions on 127.0.0.1:%d. Press Ctrl+C to stop.' % settings.port)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopped serving.')
+    finally:
+        server.server_close()
+        if pool:
+            pool.terminate()
+            pool.join()
+
+def select_maps(filenames, settings):
+    # keeps the maps named with --maps, if it is given.
+    if settings.maps == None: return filenames
+    missing = [name for name in settings.maps if name not in filenames]
+    if missing:
+        fail('Maps not found: %s.' % ', '.join(missing))
+    return [name for name in filenames if name in settings.maps]
+
+def check_layer_names(layer_names):
+    unknown = [name for name in layer_names if name not in CONVERTED_LAYER_NAMES]
+    if unknown:
+        fail('Unknown layers: %s. Only these layers can be converted: %s.' % (', '.join(unknown), ', '.join(CONVERTED_LAYER_NAMES)))
+
+def check_for_original_maps(filenames, settings, output_kind, source_extension):
+    has_missing_map = False
+    for filename in filenames:
+        if not os.path.isfile('%s/%s.map' % (settings.original_maps_dir, filename)):
+            print('The map %s/%s.map is missing!' % (settings.original_maps_dir, filename))
+            has_missing_map = True
+    if has_missing_map:
+        fail('There are missing maps from %s! We cannot generate %s files from the '
+            '%s files if the corresponding original .map files are not present.' % (settings.original_maps_dir, output_kind, source_extension))
+
 def main():
     settings = parse_args()
-    if settings.map_to_json == settings.json_to_map:
-        fail('Either convert --map-to-json or --json-to-map. Not both or none.')
+    if settings.profile:
+        start_profiling()
+    try:
+        run_mode(settings)
+    finally:
+        if settings.profile:
+            write_profile(settings.profile, PROFILE_EVENTS)
+        if settings.diagnostics:
+            write_diagnostics(settings.diagnostics, DIAGNOSTIC_REPORTS)
+
+def run_mode(settings):
+    modes = [settings.map_to_json, settings.json_to_map, settings.json_to_patch, settings.apply_patches, settings.verify, settings.serve, settings.pack, settings.unpack, settings.query != None, settings.render, settings.rebase != None, settings.check]
+    if modes.count(True) != 1:
+        fail('Either convert --map-to-json, --json-to-map, --json-to-patch, --apply-patches or --verify, --serve, --pack, --unpack, --query, --render, --rebase or --check. Not several or none.')
+
+    if settings.jobs == None:
+        # checking only reads files, so it uses every core unless told otherwise.
+        settings.jobs = 0 if settings.check else 1
+    writes_json = settings.map_to_json or settings.verify or settings.rebase != None
+    if writes_json and LAYER_ENCODINGS[settings.layer_encoding][1] == 'zstd':
+        zstd_module()
+    if writes_json and settings.tilesets:
+        map_tilesets(settings)
 
     if settings.map_to_json:
-        filenames = list(map(trim_extension, filter(is_extension('map'), os.listdir(settings.original_maps_dir))))
+        if settings.from_pack:
+            filenames = sorted(read_pack_index(settings.pack_prefix)['maps'])
+        else:
+            filenames = list(map(trim_extension, filter(is_extension('map'), os.listdir(settings.original_maps_dir))))
+        filenames = select_maps(filenames, settings)
         has_override = False
         for filename in filenames:
             if os.path.isfile('%s/%s.json' % (settings.editable_maps_dir, filename)):
@@ -658,30 +2874,96 @@ def main():
                 'Please delete them manually before running this again. '
                 'We do not automatically override .json files as they may contain unsaved data.')
 
-        for filename in filenames:
-            map_to_json(filename, settings)
+        convert_all(map_to_json, filenames, settings)
 
     elif settings.json_to_map:
         filenames = list(map(trim_extension, filter(is_extension('json'), os.listdir(settings.editable_maps_dir))))
-        has_missing_map = False
-        for filename in filenames:
-            if not os.path.isfile('%s/%s.map' % (settings.original_maps_dir, filename)):
-                print('The map %s/%s.map is missing!' % (settings.original_maps_dir, filename))
-                has_missing_map = True
-        if has_missing_map:
-            fail('There are missing maps from %s! We cannot generate map files from the '
-                '.json files if the corresponding original .map files are not present.' % settings.original_maps_dir)
+        check_for_original_maps(filenames, settings, 'map', '.json')
+        if settings.layers: check_layer_names(settings.layers)
+
+        manifest = read_manifest(settings)
+        inputs = dict((filename, build_inputs(filename, settings, manifest)) for filename in filenames)
+        if not settings.force:
+            unchanged = [f for f in filenames if is_up_to_date(f, inputs[f], manifest, settings)]
+            if unchanged:
+                print('Skipping %d unchanged maps. Use --force to rebuild them anyway.' % len(unchanged))
+            filenames = [f for f in filenames if f not in unchanged]
 
         for filename in filenames:
             if os.path.isfile('%s/%s.map' % (settings.final_maps_dir, filename)):
                 print('Automatically overriding %s/%s.map.' % (settings.final_maps_dir, filename))
 
-        for filename in filenames:
-            json_to_map(filename, settings)
+        def on_converted(filename, has_warnings):
+            record_build(filename, inputs[filename], has_warnings, manifest, settings)
+
+        if not settings.watch:
+            convert_all(json_to_map, filenames, settings, on_converted)
+        else:
+            try:
+                convert_all(json_to_map, filenames, settings, on_converted)
+            except ConversionError as e:
+                report_failure(e)
+            watch_editable_maps(settings, manifest)
+
+    elif settings.json_to_patch:
+        filenames = list(map(trim_extension, filter(is_extension('json'), os.listdir(settings.editable_maps_dir))))
+        check_for_original_maps(filenames, settings, 'patch', '.json')
+        if not os.path.isdir(settings.patch_dir): os.makedirs(settings.patch_dir)
+        convert_all(json_to_patch, filenames, settings)
+
+    elif settings.apply_patches:
+        filenames = list(map(trim_extension, filter(is_extension('mappatch'), os.listdir(settings.patch_dir))))
+        check_for_original_maps(filenames, settings, 'map', '.mappatch')
+        convert_all(patch_to_map, filenames, settings)
+
+    elif settings.verify:
+        filenames = list(map(trim_extension, filter(is_extension('map'), os.listdir(settings.original_maps_dir))))
+        mismatched = []
+        def on_converted(filename, has_warnings):
+            if has_warnings: mismatched.append(filename)
+        convert_all(verify_map, filenames, settings, on_converted)
+        if mismatched:
+            fail('%d of %d maps do not round-trip exactly: %s' % (len(mismatched), len(filenames), ', '.join(mismatched)))
+        print('All %d maps round-trip exactly.' % len(filenames))
+
+    elif settings.serve:
+        serve_conversions(settings)
+
+    elif settings.query != None:
+        run_query(settings)
+
+    elif settings.pack:
+        filenames = list(map(trim_extension, filter(is_extension('map'), os.listdir(settings.original_maps_dir))))
+        pack_maps(select_maps(filenames, settings), settings)
+
+    elif settings.unpack:
+        filenames = sorted(read_pack_index(settings.pack_prefix)['maps'])
+        if not os.path.isdir(settings.original_maps_dir): os.makedirs(settings.original_maps_dir)
+        unpack_maps(select_maps(filenames, settings), settings)
+
+    elif settings.render:
+        filenames = list(map(trim_extension, filter(is_extension('map'), os.listdir(settings.original_maps_dir))))
+        render_maps(select_maps(filenames, settings), settings)
+
+    elif settings.check:
+        filenames = list(map(trim_extension, filter(is_extension('json'), os.listdir(settings.editable_maps_dir))))
+        convert_all(validate_json, filenames, settings, keep_going=True)
+        print('All %d json files convert.' % len(filenames))
+
+    elif settings.rebase != None:
+        filenames = list(map(trim_extension, filter(is_extension('json'), os.listdir(settings.editable_maps_dir))))
+        filenames = select_maps(filenames, settings)
+        check_for_original_maps(filenames, settings, 'rebased json', '.json')
+        rebase_maps(filenames, settings)
 
 
 
 if __name__ == '__main__':
-    main()
+    multiprocessing.freeze_support()
+    try:
+        main()
+    except ConversionError as e:
+        report_failure(e)
+        sys.exit(1)
     if HAS_WARNINGS:
         sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,3 @@
+@echo off
+bin\converttojson.exe --json-to-map --watch
+pause
\ No newline at end of file